@@ -1,13 +1,114 @@
-from chatbase import Message
-from telebot.util import AsyncTask
+import asyncio
+import json
+import time
+from collections import deque
+
+import aiohttp
+from telebot import logger
 import telebot.types as types
 
-from config import CHATBASE_API_KEY
+import config
+from utils import run_sync
+
+CHATBASE_BATCH_URL = "https://chatbase.com/api/messages"
+
+
+class ChatbaseSink:
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._session = None  # type: aiohttp.ClientSession
+
+    async def send(self, events: list):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        messages = [dict(event, api_key=self.api_key, type="user", platform="telegram", version="3")
+                    for event in events]
+        async with self._session.post(CHATBASE_BATCH_URL, json={"messages": messages}) as response:
+            response.raise_for_status()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class JsonlSink:
+    def __init__(self, path: str):
+        self.path = path
+
+    def _write(self, events: list):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(event, ensure_ascii=False) + "\n" for event in events)
+
+    async def send(self, events: list):
+        await run_sync(self._write, events)
+
+    async def close(self):
+        pass
+
+
+class NullSink:
+    async def send(self, events: list):
+        pass
+
+    async def close(self):
+        pass
+
+
+def make_sink(name: str):
+    if name == "chatbase":
+        return ChatbaseSink(config.CHATBASE_API_KEY)
+    if name == "jsonl":
+        return JsonlSink(config.ANALYTICS_JSONL_PATH)
+    return NullSink()
+
+
+class AnalyticsPipeline:
+    def __init__(self, sink, queue_size: int, batch_size: int, flush_interval: float):
+        self.sink = sink
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.failed = 0
+        self.sent = 0
+
+    def push(self, event: dict):  # never blocks, drops the event when the queue is full
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append(event)
+
+    async def flush(self):
+        while self.queue:
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                await self.sink.send(batch)
+                self.sent += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.error(f"Analytics sink failed, {len(batch)} events lost: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        await self.flush()
+        await self.sink.close()
+
+    def stats(self) -> dict:
+        return {"queued": len(self.queue), "dropped": self.dropped, "failed": self.failed, "sent": self.sent}
+
+
+pipeline = AnalyticsPipeline(make_sink(config.ANALYTICS_SINK), config.ANALYTICS_QUEUE_SIZE,
+                             config.ANALYTICS_BATCH_SIZE, config.ANALYTICS_FLUSH_INTERVAL)
 
 
 def analyze(intent: str, reply_msg=False):
     def make_wrapper(foo):
-        def wrapper(*args, **kwargs):
+        async def wrapper(*args, **kwargs):
             if isinstance(args[0], types.Message):
                 if reply_msg:
                     _analyze(args[0].reply_to_message.text, intent, args[0].from_user.id)
@@ -15,18 +116,16 @@ def analyze(intent: str, reply_msg=False):
                     _analyze(args[0].text, intent, args[0].from_user.id)
             elif isinstance(args[0], types.CallbackQuery):
                 _analyze(args[0].message.text, intent, args[0].from_user.id)
-            return foo(*args, **kwargs)
+            return await foo(*args, **kwargs)
+        wrapper.__name__ = foo.__name__
         return wrapper
     return make_wrapper
 
 
 def _analyze(message: str, intent: str, user_id: int or str):
-    msg = Message(
-        api_key=CHATBASE_API_KEY,
-        platform="telegram",
-        message=message,
-        intent=intent,
-        user_id=user_id if type(user_id) == str else str(user_id),
-        version="3"
-    )
-    return AsyncTask(msg.send).wait()
+    pipeline.push({
+        "message": message,
+        "intent": intent,
+        "user_id": user_id if type(user_id) == str else str(user_id),
+        "time_stamp": int(time.time() * 1000)
+    })
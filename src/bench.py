@@ -0,0 +1,344 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import resource
+import time
+
+from aiohttp import web
+import aiohttp
+
+import config
+
+# Load test: fake Telegram Bot API and fake flibusta_server on localhost, synthetic updates through main.handle.
+# Runs against the database from settings, point DB_NAME (or DJANGO_SETTINGS_MODULE) at a scratch database.
+# Example: python bench.py search download --updates 2000 --concurrency 100 --tg-latency 0.05
+
+TELEGRAM_PORT = 18082
+FLIBUSTA_PORT = 18081
+BOT_PORT = 18080
+CHAT_ID_BASE = 10 ** 6
+DRAIN_TIMEOUT = 60
+
+WORDS = ["война", "мир", "идиот", "бесы", "море", "звезда", "остров", "сад", "ночь", "дом"]
+
+
+class FakeFlibusta:
+    def __init__(self, latency: float, results: int, book_size: int):
+        self.latency = latency
+        self.results = results
+        self.book_size = book_size
+        self.requests = 0
+
+    @staticmethod
+    def book(book_id: int) -> dict:
+        return {"id": book_id, "title": f"Книга {book_id}", "lang": "ru", "file_type": "fb2",
+                "authors": [{"id": book_id % 100 + 1, "first_name": "Лев", "last_name": "Толстой",
+                             "middle_name": "Николаевич"}]}
+
+    async def handle(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        parts = request.path.strip("/").split("/")
+        if parts[:2] in (["book", "search"], ["book", "author"]):
+            return web.json_response([self.book(i) for i in range(1, self.results + 1)])
+        if parts[:2] == ["author", "search"]:
+            return web.json_response([{"id": i, "first_name": "Имя", "last_name": f"Фамилия{i}", "middle_name": ""}
+                                      for i in range(1, self.results + 1)])
+        if parts[:2] == ["book", "download"]:
+            return web.Response(body=b"x" * self.book_size)
+        if parts[0] == "book":
+            return web.json_response(self.book(int(parts[1])))
+        if parts[0] == "author":
+            return web.json_response(self.book(int(parts[1]))["authors"][0])
+        return web.Response(status=404)
+
+
+class FakeTelegram:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.requests = 0
+        self.message_id = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        method = request.match_info["method"]
+        data = await request.post()
+        await asyncio.sleep(self.latency)
+        if method in ("setWebhook", "sendChatAction", "answerCallbackQuery", "answerInlineQuery"):
+            return web.json_response({"ok": True, "result": True})
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()), "text": "",
+                   "chat": {"id": int(data.get("chat_id", 0)), "type": "private"}}
+        if method == "sendDocument":
+            document = data["document"]
+            file_id = document if isinstance(document, str) else f"file_{self.message_id}"
+            message["document"] = {"file_id": file_id}
+        return web.json_response({"ok": True, "result": message})
+
+
+def message(chat_id: int, message_id: int, text: str, reply_to: dict = None) -> dict:
+    msg = {"message_id": message_id, "date": int(time.time()), "text": text,
+           "chat": {"id": chat_id, "type": "private"},
+           "from": {"id": chat_id, "is_bot": False, "first_name": "Bench", "username": f"bench{chat_id}"}}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if reply_to is not None:
+        msg["reply_to_message"] = reply_to
+    return msg
+
+
+def callback(chat_id: int, message_id: int, data: str, reply_to_text: str) -> dict:
+    bot_message = message(chat_id, message_id, "", message(chat_id, message_id - 1, reply_to_text))
+    return {"id": str(message_id), "from": bot_message["from"], "message": bot_message, "chat_instance": "bench",
+            "data": data}
+
+
+def search_updates(i: int, chat_id: int, args) -> dict:
+    query = f"{random.choice(WORDS)} {random.randrange(args.queries)}"
+    return {"callback_query": callback(chat_id, 2 * i + 1, random.choice(("b_1", "a_1")), query)}
+
+
+def paging_updates(i: int, chat_id: int, args) -> dict:
+    query = f"{WORDS[chat_id % len(WORDS)]} {chat_id % args.queries}"
+    return {"callback_query": callback(chat_id, 2 * i + 1, f"b_{i // args.users % 5 + 1}", query)}
+
+
+def download_updates(i: int, chat_id: int, args) -> dict:
+    return {"message": message(chat_id, i, f"/fb2_{random.randrange(1, args.books + 1)}")}
+
+
+def remove_cache_updates(i: int, chat_id: int, args) -> dict:
+    return {"callback_query": callback(chat_id, 2 * i + 1, "remove_cache",
+                                       f"/fb2_{random.randrange(1, args.books + 1)}")}
+
+
+def settings_updates(i: int, chat_id: int, args) -> dict:
+    if i < args.users or i % 3 == 0:  # every user opens settings before toggling
+        return {"message": message(chat_id, i, "/settings")}
+    data = random.choice(("uk_on", "uk_off", "be_on", "be_off"))
+    return {"callback_query": callback(chat_id, 2 * i + 1, data, "/settings")}
+
+
+SCENARIOS = {
+    "search": search_updates,
+    "paging": paging_updates,
+    "download": download_updates,
+    "remove_cache": remove_cache_updates,
+    "settings": settings_updates,
+}
+
+
+def mixed_updates(i: int, chat_id: int, args) -> dict:
+    return random.choice(list(SCENARIOS.values()))(i, chat_id, args)
+
+
+SCENARIOS["mixed"] = mixed_updates
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+        self.first = None
+
+    def emit(self, record):
+        self.count += 1
+        if self.first is None:
+            self.first = record.getMessage()
+
+
+def current_rss() -> int:  # bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+class Bench:
+    def __init__(self, main, args):
+        self.main = main
+        self.args = args
+        self.sent_at = {}  # update_id -> monotonic time of the POST
+        self.latencies = []
+        self.active = 0
+        self.queries = 0
+        self.peak_rss = 0
+        self.update_id = 0
+        self._process_update = main.bot.process_update
+        main.bot.process_update = self.process_update
+
+    async def process_update(self, update):
+        self.active += 1
+        try:
+            await self._process_update(update)
+        finally:
+            self.active -= 1
+        sent_at = self.sent_at.pop(update.update_id, None)
+        if sent_at is not None:
+            self.latencies.append(time.monotonic() - sent_at)
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    async def sample_rss(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, current_rss())
+            await asyncio.sleep(0.05)
+
+    def reset(self):
+        from filbusta_server import metadata_cache, search_cache
+        from send import filenames
+        from users import user_settings
+        for cache in (search_cache, metadata_cache, filenames, self.main.sender.pages, self.main.sender.file_ids,
+                      self.main.user_writer.seen, user_settings.allowed_langs):
+            cache.clear()
+        self.sent_at.clear()
+        self.latencies = []
+        self.queries = 0
+        self.peak_rss = current_rss()
+
+    async def run(self, name: str, session: aiohttp.ClientSession, fake_flibusta, fake_telegram) -> dict:
+        self.reset()
+        make_update = SCENARIOS[name]
+        url = f"http://127.0.0.1:{BOT_PORT}/{config.BOT_TOKEN}/"
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        rejected = 0
+        flibusta_requests, telegram_requests = fake_flibusta.requests, fake_telegram.requests
+
+        async def post(i: int):
+            nonlocal rejected
+            self.update_id += 1
+            update_id = self.update_id
+            update = make_update(i, CHAT_ID_BASE + i % self.args.users, self.args)
+            update["update_id"] = update_id
+            async with semaphore:
+                self.sent_at[update_id] = time.monotonic()
+                async with session.post(url, json=update) as response:
+                    if response.status != 200:
+                        self.sent_at.pop(update_id, None)
+                        rejected += 1
+
+        sampler = asyncio.ensure_future(self.sample_rss())
+        started = time.monotonic()
+        await asyncio.gather(*[post(i) for i in range(self.args.updates)])
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while (self.active or self.main.bot.stats()["queue_length"]) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.monotonic() - started
+        sampler.cancel()
+        latencies = sorted(self.latencies)
+        return {
+            "scenario": name,
+            "updates": self.args.updates,
+            "handled": len(latencies),
+            "rejected": rejected,
+            "dropped": len(self.sent_at),  # superseded, shed or still running at the deadline
+            "updates_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "peak_rss_mb": self.peak_rss / 2 ** 20,
+            "db_queries": self.queries,
+            "flibusta_requests": fake_flibusta.requests - flibusta_requests,
+            "telegram_requests": fake_telegram.requests - telegram_requests,
+        }
+
+
+def print_report(results: list):
+    columns = ("scenario", "handled", "rejected", "dropped", "updates_per_sec", "p50_ms", "p95_ms", "p99_ms",
+               "peak_rss_mb", "db_queries", "flibusta_requests", "telegram_requests", "errors")
+    print(" ".join(f"{column:>17}" for column in columns))
+    for result in results:
+        print(" ".join(f"{result[column]:>17.1f}" if isinstance(result[column], float) else
+                       f"{result[column]:>17}" for column in columns))
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def run(args) -> list:
+    import main
+    from django.db.backends.signals import connection_created
+
+    bench = Bench(main, args)
+    connection_created.connect(lambda sender, connection, **kwargs: connection.execute_wrappers.append(
+        bench.count_query), weak=False)
+    errors = ErrorCounter()
+    logging.getLogger("TeleBot").handlers = [errors]  # count handler errors instead of printing every traceback
+
+    fake_flibusta = FakeFlibusta(args.backend_latency, args.results, args.book_size)
+    flibusta_app = web.Application()
+    flibusta_app.router.add_route("GET", "/{tail:.*}", fake_flibusta.handle)
+    fake_telegram = FakeTelegram(args.tg_latency)
+    telegram_app = web.Application(client_max_size=2 * config.DOWNLOAD_MAX_SIZE)
+    telegram_app.router.add_post("/bot{token}/{method}", fake_telegram.handle)
+    runners = [await start_site(flibusta_app, FLIBUSTA_PORT), await start_site(telegram_app, TELEGRAM_PORT),
+               await start_site(main.make_app(), BOT_PORT)]
+
+    results = []
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            for name in args.scenarios:
+                errors.count, errors.first = 0, None
+                result = await bench.run(name, session, fake_flibusta, fake_telegram)
+                result["errors"] = errors.count
+                if errors.first:
+                    print(f"{name}: {errors.count} errors, first: {errors.first}")
+                results.append(result)
+    finally:
+        for runner in reversed(runners):
+            await runner.cleanup()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the bot against fake Telegram and flibusta servers")
+    parser.add_argument("scenarios", nargs="*", default=["mixed"], help=", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--updates", type=int, default=1000, help="updates per scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="webhook requests in flight")
+    parser.add_argument("--users", type=int, default=100, help="distinct chats")
+    parser.add_argument("--queries", type=int, default=20, help="distinct search queries")
+    parser.add_argument("--books", type=int, default=50, help="distinct books to download")
+    parser.add_argument("--results", type=int, default=50, help="search results returned by the backend")
+    parser.add_argument("--book-size", type=int, default=500 * 1024, help="downloaded book size in bytes")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="Telegram API latency in seconds")
+    parser.add_argument("--backend-latency", type=float, default=0.05, help="flibusta_server latency in seconds")
+    parser.add_argument("--no-rate-limit", action="store_true", help="lift the Telegram send rate limits")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config.BOT_TOKEN = "0:bench"
+    config.FLIBUSTA_SERVER = f"http://127.0.0.1:{FLIBUSTA_PORT}"
+    config.TELEGRAM_API_URL = f"http://127.0.0.1:{TELEGRAM_PORT}/bot{{0}}/{{1}}"
+    config.RUN_MODE = "webhook"
+    config.ANALYTICS_SINK = "null"
+    if args.no_rate_limit:
+        config.TELEGRAM_GLOBAL_RATE = config.TELEGRAM_CHAT_RATE = config.TELEGRAM_GROUP_RATE = 10 ** 6
+        config.TELEGRAM_CHAT_BURST = 10 ** 6
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
@@ -0,0 +1,378 @@
+import asyncio
+import io
+import re
+import time
+from collections import OrderedDict, deque
+
+import aiohttp
+from aiohttp.payload import Payload
+from telebot import logger, util
+import telebot.types as ttypes
+
+import metrics
+from ratelimit import SendScheduler, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from utils import run_sync
+
+API_URL = "https://api.telegram.org/bot{0}/{1}"
+POLLING_ERROR_DELAY = 3
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class ApiException(Exception):
+    def __init__(self, method_name: str, result: dict):
+        super().__init__(f"A request to the Telegram API was unsuccessful. "
+                         f"{method_name}: {result.get('error_code')} {result.get('description')}")
+        self.method_name = method_name
+        self.error_code = result.get("error_code")
+        self.description = result.get("description")
+        self.parameters = result.get("parameters") or {}
+
+
+class UploadPayload(Payload):  # streams in chunks, unlike aiohttp's own payloads it leaves files open for a retry
+    def __init__(self, value, **kwargs):
+        super().__init__(value, **kwargs)
+        if isinstance(value, (bytes, bytearray, memoryview)):  # memoryview of a cached file's mmap
+            self._size = memoryview(value).nbytes
+        else:
+            value.seek(0, io.SEEK_END)
+            self._size = value.tell()
+
+    async def write(self, writer):
+        if isinstance(self._value, (bytes, bytearray, memoryview)):
+            view = memoryview(self._value)
+            for offset in range(0, len(view), UPLOAD_CHUNK_SIZE):  # slices of the page cache, not copies
+                await writer.write(view[offset:offset + UPLOAD_CHUNK_SIZE])
+            return
+        self._value.seek(0)
+        while True:
+            if isinstance(self._value, io.BytesIO):
+                chunk = self._value.read(UPLOAD_CHUNK_SIZE)
+            else:
+                chunk = await run_sync(self._value.read, UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await writer.write(chunk)  # drains the transport between chunks
+
+    def decode(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        raise TypeError("uploads are streamed, not decoded")
+
+
+def update_chat_id(update: ttypes.Update) -> int or None:
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.inline_query is not None:
+        return update.inline_query.from_user.id
+    return None
+
+
+def _convert_param(value):
+    if isinstance(value, ttypes.JsonSerializable):
+        return value.to_json()
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class AsyncBot:
+    def __init__(self, token: str, max_concurrent_updates: int = 16, scheduler: SendScheduler = None,
+                 max_retries: int = 3, queue_size: int = 1000, overflow_policy: str = "reject", superseded_key=None,
+                 api_url: str = API_URL, slow_update_threshold: float = None):
+        self.token = token
+        self.api_url = api_url
+        self.max_concurrent_updates = max_concurrent_updates
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy  # "reject" or "shed"
+        self.superseded_key = superseded_key  # update -> key, only the latest queued update with a key is handled
+        self.slow_update_threshold = slow_update_threshold  # seconds, log the stage breakdown of slower updates
+        self.message_handlers = []
+        self.callback_query_handlers = []
+        self.inline_query_handlers = []
+        self.rejected = 0
+        self.shed = 0
+        self.superseded = 0
+        self._session = None  # type: aiohttp.ClientSession
+        self._queue = None  # type: asyncio.Queue
+        self._queued_by_key = {}
+        self._chat_backlogs = {}  # chat_id -> updates of a chat that is being handled, oldest first
+        self._workers = []
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        if self.scheduler is not None:
+            await self.scheduler.close()
+        if self._session is not None:
+            await self._session.close()
+
+    async def _make_request(self, method_name: str, params: dict = None, files: dict = None, chat_id: int = None,
+                            priority: int = PRIORITY_NORMAL):
+        for attempt in range(self.max_retries + 1):
+            if self.scheduler is not None and chat_id is not None:
+                with metrics.timed(metrics.RATE_LIMIT_SECONDS, "rate_limit"):
+                    await self.scheduler.acquire(chat_id, priority)
+            try:
+                return await self._send_request(method_name, params, files)
+            except ApiException as e:
+                retry_after = e.parameters.get("retry_after")
+                if e.error_code != 429 or retry_after is None or attempt == self.max_retries:
+                    raise
+                logger.warning(f"{method_name}: flood control, retry in {retry_after} seconds")
+                if self.scheduler is not None and chat_id is not None:
+                    self.scheduler.pause(chat_id, retry_after)
+                else:
+                    await asyncio.sleep(retry_after)
+
+    async def _send_request(self, method_name: str, params: dict = None, files: dict = None):
+        params = {k: _convert_param(v) for k, v in (params or {}).items() if v is not None}
+        if files:
+            data = aiohttp.FormData()
+            for key, value in params.items():
+                data.add_field(key, value)
+            for key, file in files.items():
+                if isinstance(file, tuple):
+                    filename, file = file
+                else:
+                    filename = getattr(file, "name", None) or key
+                data.add_field(key, UploadPayload(file), filename=filename)
+        else:
+            data = params
+        session = await self._get_session()
+        with metrics.timed(metrics.TELEGRAM_SECONDS, "telegram", method_name):
+            async with session.post(self.api_url.format(self.token, method_name), data=data) as response:
+                result = await response.json()
+        if not result["ok"]:
+            metrics.TELEGRAM_ERRORS.inc(method_name, result.get("error_code"))
+            raise ApiException(method_name, result)
+        return result["result"]
+
+    async def set_webhook(self, url: str):
+        return await self._make_request("setWebhook", {"url": url})
+
+    async def remove_webhook(self):
+        return await self.set_webhook("")
+
+    async def get_updates(self, offset: int = None, limit: int = None, timeout: int = None) -> list:
+        result = await self._make_request("getUpdates", {"offset": offset, "limit": limit, "timeout": timeout})
+        return [ttypes.Update.de_json(update) for update in result]
+
+    async def send_message(self, chat_id: int, text: str, disable_web_page_preview=None, reply_to_message_id=None,
+                           reply_markup=None, parse_mode=None) -> ttypes.Message:
+        return ttypes.Message.de_json(await self._make_request("sendMessage", {
+            "chat_id": chat_id, "text": text, "disable_web_page_preview": disable_web_page_preview,
+            "reply_to_message_id": reply_to_message_id, "reply_markup": reply_markup, "parse_mode": parse_mode
+        }, chat_id=chat_id))
+
+    async def reply_to(self, message: ttypes.Message, text: str, **kwargs) -> ttypes.Message:
+        return await self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    async def send_document(self, chat_id: int, data, reply_to_message_id=None, caption=None,
+                            reply_markup=None, parse_mode=None, filename=None,
+                            priority: int = PRIORITY_HIGH) -> ttypes.Message:
+        params = {"chat_id": chat_id, "reply_to_message_id": reply_to_message_id, "caption": caption,
+                  "reply_markup": reply_markup, "parse_mode": parse_mode}
+        files = None
+        if util.is_string(data):
+            params["document"] = data
+        else:
+            files = {"document": (filename, data) if filename else data}
+        return ttypes.Message.de_json(await self._make_request("sendDocument", params, files, chat_id=chat_id,
+                                                               priority=priority))
+
+    async def send_chat_action(self, chat_id: int, action: str):
+        if self.scheduler is not None and not self.scheduler.should_send_chat_action(chat_id, action):
+            return True
+        return await self._make_request("sendChatAction", {"chat_id": chat_id, "action": action},
+                                        chat_id=chat_id, priority=PRIORITY_LOW)
+
+    async def answer_inline_query(self, inline_query_id: str, results: list, cache_time=None, is_personal=None,
+                                  next_offset=None, switch_pm_text=None, switch_pm_parameter=None):
+        return await self._make_request("answerInlineQuery", {
+            "inline_query_id": inline_query_id, "results": "[" + ",".join(r.to_json() for r in results) + "]",
+            "cache_time": cache_time, "is_personal": is_personal, "next_offset": next_offset,
+            "switch_pm_text": switch_pm_text, "switch_pm_parameter": switch_pm_parameter
+        })
+
+    async def edit_message_text(self, text: str, chat_id=None, message_id=None, inline_message_id=None,
+                                parse_mode=None, disable_web_page_preview=None, reply_markup=None):
+        result = await self._make_request("editMessageText", {
+            "text": text, "chat_id": chat_id, "message_id": message_id, "inline_message_id": inline_message_id,
+            "parse_mode": parse_mode, "disable_web_page_preview": disable_web_page_preview,
+            "reply_markup": reply_markup
+        }, chat_id=chat_id, priority=PRIORITY_HIGH)
+        if isinstance(result, bool):
+            return result
+        return ttypes.Message.de_json(result)
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, inline_message_id=None,
+                                        reply_markup=None):
+        result = await self._make_request("editMessageReplyMarkup", {
+            "chat_id": chat_id, "message_id": message_id, "inline_message_id": inline_message_id,
+            "reply_markup": reply_markup
+        }, chat_id=chat_id, priority=PRIORITY_HIGH)
+        if isinstance(result, bool):
+            return result
+        return ttypes.Message.de_json(result)
+
+    def message_handler(self, commands=None, regexp=None, func=None, content_types=None):
+        if content_types is None:
+            content_types = ["text"]
+
+        def decorator(handler):
+            self.message_handlers.append({
+                "function": handler,
+                "filters": {"content_types": content_types, "commands": commands, "regexp": regexp, "func": func}
+            })
+            return handler
+        return decorator
+
+    def callback_query_handler(self, func):
+        def decorator(handler):
+            self.callback_query_handlers.append({"function": handler, "filters": {"func": func}})
+            return handler
+        return decorator
+
+    def inline_handler(self, func):
+        def decorator(handler):
+            self.inline_query_handlers.append({"function": handler, "filters": {"func": func}})
+            return handler
+        return decorator
+
+    @staticmethod
+    def _test_filter(filter_: str, filter_value, obj) -> bool:
+        if filter_ == "content_types":
+            return obj.content_type in filter_value
+        if filter_ == "regexp":
+            return obj.content_type == "text" and re.search(filter_value, obj.text, re.IGNORECASE) is not None
+        if filter_ == "commands":
+            return obj.content_type == "text" and util.extract_command(obj.text) in filter_value
+        if filter_ == "func":
+            return bool(filter_value(obj))
+        return False
+
+    def _find_handler(self, handlers: list, obj):
+        for handler in handlers:
+            if all(self._test_filter(f, v, obj) for f, v in handler["filters"].items() if v is not None):
+                return handler["function"]
+        return None
+
+    async def process_update(self, update: ttypes.Update):
+        if update.message is not None:
+            handler = self._find_handler(self.message_handlers, update.message)
+            obj = update.message
+        elif update.callback_query is not None:
+            handler = self._find_handler(self.callback_query_handlers, update.callback_query)
+            obj = update.callback_query
+        elif update.inline_query is not None:
+            handler = self._find_handler(self.inline_query_handlers, update.inline_query)
+            obj = update.inline_query
+        else:
+            return
+        if handler is None:
+            metrics.UPDATES.inc("none", "unhandled")
+            return
+        status = "ok"
+        started = time.monotonic()
+        with metrics.trace_update(update.update_id) as trace:
+            try:
+                await handler(obj)
+            except Exception as e:
+                status = "error"
+                logger.exception(f"{handler.__name__}: {e}")
+        seconds = time.monotonic() - started
+        metrics.UPDATES.inc(handler.__name__, status)
+        metrics.UPDATE_SECONDS.observe(seconds, handler.__name__)
+        if self.slow_update_threshold is not None and seconds > self.slow_update_threshold:
+            logger.warning(f"Slow update {update.update_id} {handler.__name__}: {seconds:.3f}s ({trace.format()})")
+
+    async def _worker(self):  # chats run concurrently, updates of one chat in order
+        while True:
+            item = await self._queue.get()
+            # inline queries of a user supersede each other instead, InlineSearch cancels the older one
+            chat_id = update_chat_id(item[0]) if item[0].inline_query is None else None
+            backlog = self._chat_backlogs.get(chat_id) if chat_id is not None else None
+            if backlog is not None:  # the worker handling this chat takes it next
+                backlog.append(item)
+                continue
+            backlog = deque([item])
+            if chat_id is not None:
+                self._chat_backlogs[chat_id] = backlog
+            try:
+                while backlog:
+                    item = backlog[0]
+                    if item[1] is not None and self._queued_by_key.get(item[1]) is item:
+                        del self._queued_by_key[item[1]]
+                    await self.process_update(item[0])
+                    backlog.popleft()
+            finally:
+                if chat_id is not None:
+                    del self._chat_backlogs[chat_id]
+
+    def enqueue(self, update: ttypes.Update) -> bool:  # False means the update should be redelivered later
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.queue_size)
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.max_concurrent_updates)]
+        key = self.superseded_key(update) if self.superseded_key is not None else None
+        queued = self._queued_by_key.get(key) if key is not None else None
+        if queued is not None:
+            queued[0] = update
+            self.superseded += 1
+            return True
+        item = [update, key]
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            if self.overflow_policy == "shed" and key is not None:
+                self.shed += 1
+                return True
+            self.rejected += 1
+            return False
+        if key is not None:
+            self._queued_by_key[key] = item
+        return True
+
+    async def process_batch(self, updates: list):  # chats run concurrently, updates of one chat in order
+        semaphore = asyncio.Semaphore(self.max_concurrent_updates)
+        by_chat = OrderedDict()
+        for update in updates:
+            by_chat.setdefault(update_chat_id(update), []).append(update)
+
+        async def process_chat(chat_updates: list):
+            for update in chat_updates:
+                async with semaphore:
+                    await self.process_update(update)
+
+        await asyncio.gather(*[process_chat(chat_updates) for chat_updates in by_chat.values()])
+
+    async def polling(self, limit: int = 100, timeout: int = 30):
+        offset = None
+        while True:
+            try:
+                updates = await self.get_updates(offset, limit, timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ApiException) as e:
+                logger.error(f"getUpdates: {e}")
+                await asyncio.sleep(POLLING_ERROR_DELAY)
+                continue
+            if updates:
+                await self.process_batch(updates)
+                offset = updates[-1].update_id + 1  # confirm the batch only after it was handled
+
+    def stats(self) -> dict:
+        return {
+            "queue_length": self._queue.qsize() if self._queue is not None else 0,
+            "chat_backlog": sum(len(backlog) - 1 for backlog in self._chat_backlogs.values()),
+            "queue_size": self.queue_size,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "superseded": self.superseded,
+        }
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float, max_weight: int = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, weight, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        if item[0] <= time.monotonic():
+            self.pop(key)
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[2]
+
+    def set(self, key, value, weight: int = 1, ttl: float = None):
+        self.pop(key)
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), weight, value)
+        self.weight += weight
+        while len(self._data) > self.max_size or (self.max_weight is not None and self.weight > self.max_weight):
+            _, (_, old_weight, _) = self._data.popitem(last=False)
+            self.weight -= old_weight
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.weight -= item[1]
+        return item[2]
+
+    def clear(self):
+        self._data.clear()
+        self.weight = 0
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "weight": self.weight, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+from telebot import logger
+
+import config
+from http_client import flibusta_client
+from utils import run_sync
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.db.models.functions import Length
+
+application = get_wsgi_application()
+
+from db.models import CatalogAuthor, CatalogBook
+
+# Local mirror of the flibusta_server catalog, used by searches when CATALOG_ENABLED is set.
+# python catalog.py import books.jsonl  - load a dump, one book JSON object (as /book/<id> returns it) per line
+# python catalog.py refresh             - page flibusta_server for books newer than the last imported one
+# python catalog.py bench <query>...    - compare local and remote search latency
+# python catalog.py indexes             - trigram indexes for searches on PostgreSQL, creating the pg_trgm extension
+#                                         needs a superuser before PostgreSQL 13 (or CREATE EXTENSION pg_trgm by hand)
+
+
+def author_to_dict(author: CatalogAuthor) -> dict:
+    return {"id": author.id, "first_name": author.first_name, "last_name": author.last_name,
+            "middle_name": author.middle_name}
+
+
+def book_to_dict(book: CatalogBook) -> dict:
+    return {"id": book.id, "title": book.title, "lang": book.lang, "file_type": book.file_type,
+            "authors": [author_to_dict(author) for author in book.authors.all()]}
+
+
+def get_book(book_id: int) -> dict or None:
+    book = CatalogBook.objects.prefetch_related("authors").filter(id=book_id).first()
+    return book_to_dict(book) if book is not None else None
+
+
+def _contains_words(field: str, query: str) -> Q:
+    condition = Q()
+    for word in query.split():
+        condition &= Q(**{f"{field}__icontains": word})
+    return condition
+
+
+def _langs(allowed_langs) -> list:
+    return list(config.CATALOG_DEFAULT_LANGS) + list(allowed_langs or ())
+
+
+def search_books(query: str, allowed_langs=None) -> list:  # shortest matching titles are the closest ones
+    books = (CatalogBook.objects.filter(_contains_words("title", query), lang__in=_langs(allowed_langs))
+             .annotate(title_length=Length("title")).order_by("title_length", "id")
+             .prefetch_related("authors")[:config.CATALOG_SEARCH_LIMIT])
+    return [book_to_dict(book) for book in books]
+
+
+def books_by_author(author_id: int, allowed_langs=None) -> list:
+    books = (CatalogBook.objects.filter(authors__id=author_id, lang__in=_langs(allowed_langs))
+             .order_by("title", "id").prefetch_related("authors")[:config.CATALOG_SEARCH_LIMIT])
+    return [book_to_dict(book) for book in books]
+
+
+def search_authors(query: str) -> list:
+    authors = (CatalogAuthor.objects.filter(_contains_words("name", query))
+               .annotate(name_length=Length("name")).order_by("name_length", "id")[:config.CATALOG_SEARCH_LIMIT])
+    return [author_to_dict(author) for author in authors]
+
+
+def create_trigram_indexes():  # speeds up icontains, which is UPPER(column::text) LIKE
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for model, column in ((CatalogBook, "title"), (CatalogAuthor, "name")):
+            table = model._meta.db_table
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column}_trgm ON {table} "
+                           f"USING gin (UPPER({column}::text) gin_trgm_ops)")
+
+
+def _upsert(cursor, table: str, columns: tuple, rows: list):
+    values = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows))
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns[1:])
+    cursor.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values} "
+                   f"ON CONFLICT ({columns[0]}) DO UPDATE SET {updates}",
+                   [value for row in rows for value in row])
+
+
+def upsert_books(books: list):
+    authors = {author["id"]: author for book in books for author in book.get("authors") or ()}
+    links = [(book["id"], author["id"]) for book in books for author in book.get("authors") or ()]
+    link_table = CatalogBook.authors.through._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        if authors:
+            _upsert(cursor, CatalogAuthor._meta.db_table, ("id", "first_name", "last_name", "middle_name", "name"), [
+                (a["id"], a["first_name"], a["last_name"], a["middle_name"],
+                 ' '.join(n for n in (a["last_name"], a["first_name"], a["middle_name"]) if n))
+                for a in authors.values()
+            ])
+        _upsert(cursor, CatalogBook._meta.db_table, ("id", "title", "lang", "file_type"),
+                [(b["id"], b["title"], b["lang"], b["file_type"]) for b in books])
+        cursor.execute(f"DELETE FROM {link_table} WHERE catalogbook_id IN ({', '.join(['%s'] * len(books))})",
+                       [book["id"] for book in books])
+        if links:
+            cursor.execute(f"INSERT INTO {link_table} (catalogbook_id, catalogauthor_id) VALUES "
+                           f"{', '.join(['(%s, %s)'] * len(links))}", [value for link in links for value in link])
+
+
+def import_dump(path: str) -> int:
+    imported = 0
+    batch = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) >= config.CATALOG_IMPORT_BATCH:
+                upsert_books(batch)
+                imported += len(batch)
+                batch = []
+    if batch:
+        upsert_books(batch)
+        imported += len(batch)
+    return imported
+
+
+def last_book_id() -> int:
+    return CatalogBook.objects.aggregate(last=Max("id"))["last"] or 0
+
+
+async def import_from_backend() -> int:  # incremental, continues after the last imported id
+    semaphore = asyncio.Semaphore(config.CATALOG_IMPORT_CONCURRENCY)
+
+    async def fetch(book_id: int) -> dict or None:
+        async with semaphore:
+            status, content = await flibusta_client.get(f"{config.FLIBUSTA_SERVER}/book/{book_id}", "lookup")
+        return json.loads(content) if status == 200 else None
+
+    next_id = await run_sync(last_book_id) + 1
+    imported = 0
+    missing = 0  # ids without a book in a row, ids have gaps but a long run means we passed the newest book
+    while missing < config.CATALOG_IMPORT_MAX_GAP:
+        books = await asyncio.gather(*[fetch(book_id)
+                                       for book_id in range(next_id, next_id + config.CATALOG_IMPORT_BATCH)])
+        for book in books:
+            missing = 0 if book is not None else missing + 1
+        found = [book for book in books if book is not None]
+        if found:
+            await run_sync(upsert_books, found)
+            imported += len(found)
+        next_id += config.CATALOG_IMPORT_BATCH
+    return imported
+
+
+async def refresh_loop():
+    while True:
+        try:
+            imported = await import_from_backend()
+            logger.info(f"Catalog refresh: {imported} new books")
+        except Exception as e:
+            logger.exception(f"Catalog refresh: {e}")
+        await asyncio.sleep(config.CATALOG_REFRESH_INTERVAL)
+
+
+async def benchmark(queries: list, repeat: int = 5):
+    from bench import percentile
+
+    async def remote(query: str):
+        status, content = await flibusta_client.get(f"{config.FLIBUSTA_SERVER}/book/search/{query}", "search")
+        return json.loads(content)
+
+    async def local(query: str):
+        return await run_sync(search_books, query)
+
+    for name, search in (("remote", remote), ("local", local)):
+        timings = []
+        for query in queries:
+            for _ in range(repeat):
+                started = time.monotonic()
+                await search(query)
+                timings.append(time.monotonic() - started)
+        timings.sort()
+        print(f"{name}: p50 {percentile(timings, 0.5) * 1000:.1f} ms, p95 {percentile(timings, 0.95) * 1000:.1f} ms, "
+              f"max {timings[-1] * 1000:.1f} ms")
+
+
+async def run(command: str, args: list):
+    try:
+        if command == "import":
+            print(f"{await run_sync(import_dump, args[0])} books imported")
+        elif command == "refresh":
+            print(f"{await import_from_backend()} books imported")
+        elif command == "bench":
+            await benchmark(args)
+        elif command == "indexes":
+            await run_sync(create_trigram_indexes)
+    finally:
+        await flibusta_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(run(sys.argv[1], sys.argv[2:]))
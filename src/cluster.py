@@ -0,0 +1,91 @@
+import asyncio
+import json
+import multiprocessing
+
+import aiohttp
+from aiohttp import web
+from telebot import logger
+
+import config
+from bot import AsyncBot
+
+SUPERVISE_INTERVAL = 1
+
+
+def chat_id_of(update: dict) -> int:  # same chat always lands on the same worker
+    message = (update.get("message") or update.get("edited_message")
+               or (update.get("callback_query") or {}).get("message"))  # absent for inline message buttons
+    if message is not None:
+        return message["chat"]["id"]
+    for kind in ("callback_query", "inline_query", "chosen_inline_result"):
+        if kind in update:
+            return update[kind]["from"]["id"]
+    return update.get("update_id", 0)
+
+
+def worker_url(index: int) -> str:
+    return f"http://127.0.0.1:{config.WORKER_BASE_PORT + index}/{config.BOT_TOKEN}/"
+
+
+def worker_main(index: int):
+    import main
+    web.run_app(main.make_app(worker=index), host="127.0.0.1", port=config.WORKER_BASE_PORT + index)
+
+
+def start_worker(index: int) -> multiprocessing.Process:
+    # not daemonic, a daemonic process can't start the conversion pool, on_cleanup terminates workers
+    process = multiprocessing.Process(target=worker_main, args=(index,), name=f"worker-{index}")
+    process.start()
+    return process
+
+
+async def handle(request):
+    if request.match_info.get('token') != config.BOT_TOKEN:
+        return web.Response(status=403)
+    body = await request.read()
+    index = chat_id_of(json.loads(body)) % config.WORKER_PROCESSES
+    try:
+        async with request.app["session"].post(worker_url(index), data=body,
+                                               headers={"Content-Type": "application/json"}) as response:
+            return web.Response(status=response.status)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"worker-{index}: {e}")
+        return web.Response(status=config.INTAKE_OVERFLOW_STATUS)  # Telegram redelivers it later
+
+
+async def supervise(app):
+    while True:
+        await asyncio.sleep(SUPERVISE_INTERVAL)
+        for index, process in enumerate(app["workers"]):
+            if not process.is_alive():
+                logger.error(f"worker-{index} exited with {process.exitcode}, restarting")
+                app["workers"][index] = start_worker(index)
+
+
+async def on_startup(app):
+    app["session"] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    app["supervisor"] = asyncio.ensure_future(supervise(app))
+    bot = AsyncBot(config.BOT_TOKEN, api_url=config.TELEGRAM_API_URL)
+    await bot.remove_webhook()
+    await bot.set_webhook(url=config.WEBHOOK_HOST + "/{}/".format(config.BOT_TOKEN))
+    await bot.close()
+
+
+async def on_cleanup(app):
+    app["supervisor"].cancel()
+    await app["session"].close()
+    for process in app["workers"]:
+        process.terminate()
+    for process in app["workers"]:
+        process.join()
+
+
+def run():
+    if config.RUN_MODE == "polling":
+        raise ValueError("WORKER_PROCESSES > 1 needs RUN_MODE = \"webhook\"")
+    app = web.Application()
+    app["workers"] = [start_worker(index) for index in range(config.WORKER_PROCESSES)]
+    app.router.add_post('/{token}/', handle)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    web.run_app(app, host=config.SERVER_HOST, port=config.SERVER_PORT)
@@ -9,6 +9,57 @@ DB_HOST = ""
 DB_PORT = ""
 
 FLIBUSTA_SERVER = ""
+FLIBUSTA_POOL_SIZE = 32
+FLIBUSTA_KEEPALIVE_TIMEOUT = 30
+FLIBUSTA_TIMEOUTS = {  # endpoint: (connect, read) in seconds
+    "lookup": (3, 10),
+    "search": (3, 30),
+    "download": (5, 120),
+}
+FLIBUSTA_RETRIES = 2
+FLIBUSTA_RETRY_BACKOFF = 0.5
+
+DOWNLOAD_MAX_SIZE = 30 * 1000000  # bigger books are sent as a download link
+DOWNLOAD_MEMORY_LIMIT = 2 * 1024 * 1024  # bigger bodies are spooled to a temp file
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+FILE_CACHE_DIR = None  # downloaded books kept on disk, shared by all bot processes on the host
+FILE_CACHE_MAX_BYTES = 20 * 1024 ** 3
+FILE_CACHE_EVICT_TO = 0.9  # an eviction removes least recently used files down to this share of the limit
+
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 15 * 60
+SEARCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+METADATA_CACHE_SIZE = 50000  # book and author records by id
+METADATA_CACHE_MAX_BYTES = 64 * 1024 * 1024  # approximate, a parsed book takes about 2 KB
+METADATA_CACHE_TTL = 24 * 60 * 60
+METADATA_CACHE_MISSING_TTL = 5 * 60  # ids flibusta_server answered with 204
+
+PAGE_CACHE_SIZE = 20000  # rendered result pages
+PAGE_CACHE_TTL = 15 * 60
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+FILENAME_CACHE_SIZE = 2000
+FILENAME_CACHE_TTL = 60 * 60
+
+FILE_ID_CACHE_SIZE = 50000
+FILE_ID_CACHE_TTL = 60 * 60
+FILE_ID_CACHE_CLUSTER_TTL = 60  # with WORKER_PROCESSES > 1, other workers may still send a removed file_id this long
+
+USER_CACHE_SIZE = 100000
+USER_CACHE_TTL = 6 * 60 * 60
+USER_FLUSH_INTERVAL = 5
+USER_FLUSH_BATCH_SIZE = 500
+
+SETTINGS_CACHE_SIZE = 100000
+SETTINGS_CACHE_TTL = 6 * 60 * 60
+
+RUN_MODE = "webhook"  # "webhook" or "polling"
+POLLING_LIMIT = 100
+POLLING_TIMEOUT = 30
+
+TELEGRAM_API_URL = "https://api.telegram.org/bot{0}/{1}"
 
 WEBHOOK_PORT = 443
 WEBHOOK_HOST = f"https://site.ru:{WEBHOOK_PORT}/{BOT_NAME}"
@@ -17,4 +68,59 @@ WEBHOOK_LISTEN = "0.0.0.0"
 SERVER_HOST = "0.0.0.0"
 SERVER_PORT = 7770
 
+WORKER_PROCESSES = 1  # more than 1 starts a front process that routes updates to workers by chat
+WORKER_BASE_PORT = SERVER_PORT + 1  # workers listen on 127.0.0.1:WORKER_BASE_PORT + index
+SINGLE_FLIGHT_LOCK_DIR = f"/tmp/{BOT_NAME}_locks"
+
 CHATBASE_API_KEY = ""
+
+ANALYTICS_SINK = "chatbase"  # chatbase, jsonl or null
+ANALYTICS_JSONL_PATH = "analytics.jsonl"
+ANALYTICS_QUEUE_SIZE = 10000
+ANALYTICS_BATCH_SIZE = 100
+ANALYTICS_FLUSH_INTERVAL = 5
+
+MAX_CONCURRENT_UPDATES = 16
+INTAKE_QUEUE_SIZE = 1000
+# when the intake queue is full "reject" answers every update with INTAKE_OVERFLOW_STATUS,
+# "shed" drops page flip callbacks and rejects the rest
+INTAKE_OVERFLOW_POLICY = "shed"
+INTAKE_OVERFLOW_STATUS = 503  # Telegram redelivers updates answered with an error
+
+PREWARM_ENABLED = False
+PREWARM_CHAT_ID = None  # private chat or channel where the bot posts prewarmed books
+PREWARM_INTERVAL = 60 * 60
+PREWARM_TOP = 200  # most requested books without a posted file, per run
+PREWARM_BOOKS = []  # (book_id, file_type) warmed on every run
+PREWARM_CONCURRENCY = 2
+PREWARM_BUDGET = 1024 ** 3  # bytes downloaded per run
+BOOK_REQUESTS_FLUSH_INTERVAL = 10
+
+CONVERT_ENABLED = False  # convert fb2 locally when flibusta_server can't give an epub or mobi
+CONVERT_COMMAND = ["ebook-convert"]  # called with the source and target paths appended
+CONVERT_FORMATS = ["epub", "mobi"]
+CONVERT_PROCESSES = 2
+CONVERT_QUEUE_SIZE = 16  # conversions waiting or running, more are answered with an error
+CONVERT_TIMEOUT = 120  # seconds per conversion, the converter is killed after it
+CONVERT_PREFETCH = True  # with FILE_CACHE_DIR set, also convert the other formats of the book into the cache
+
+INLINE_PAGE_SIZE = 20  # results per answerInlineQuery, Telegram allows up to 50
+INLINE_CACHE_TIME = 300  # seconds Telegram may serve a cached answer without asking the bot
+INLINE_MIN_QUERY_LENGTH = 3
+
+CATALOG_ENABLED = False  # search the local catalog instead of flibusta_server, fill it with catalog.py first
+CATALOG_DEFAULT_LANGS = ["ru"]  # returned by every catalog search, the user's allowed languages are added
+CATALOG_SEARCH_LIMIT = 500
+CATALOG_IMPORT_BATCH = 1000
+CATALOG_IMPORT_CONCURRENCY = 16
+CATALOG_IMPORT_MAX_GAP = 1000  # missing ids in a row that end paging flibusta_server
+CATALOG_REFRESH_INTERVAL = None  # seconds between incremental imports from flibusta_server
+
+METRICS_ENABLED = True  # Prometheus metrics on /<BOT_TOKEN>/metrics
+SLOW_UPDATE_THRESHOLD = None  # seconds, updates handled slower are logged with a per-stage breakdown
+
+TELEGRAM_GLOBAL_RATE = 30  # messages per second
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_RETRIES = 3  # on 429 Too Many Requests
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import aiohttp
+from telebot import logger
+
+import metrics
+from file_cache import CachedFile, file_cache
+from filbusta_server import Book, DownloadResult
+from utils import run_sync
+
+
+def run_converter(command: list, source: str, target: str, timeout: float):  # runs in a pool process
+    try:
+        subprocess.run(command + [source, target], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, timeout=timeout, check=True)
+    except subprocess.CalledProcessError as e:
+        raise subprocess.SubprocessError(f"{command[0]} exited with {e.returncode}: {e.stderr[-500:]!r}")
+
+
+def write_file(path: str, data):
+    with open(path, "wb") as out:
+        if isinstance(data, memoryview):
+            out.write(data)
+        else:
+            shutil.copyfileobj(data, out)
+
+
+def store(book_id: int, file_type: str, path: str) -> CachedFile:
+    if file_cache is not None:
+        with open(path, "rb") as f:
+            file_cache.put(book_id, file_type, f)
+    return CachedFile(path)  # the mapping outlives the removed work directory
+
+
+class Converter:  # local fb2 -> epub/mobi when flibusta_server fails to give them
+    def __init__(self, command: list, formats: list, processes: int, queue_size: int, timeout: float,
+                 prefetch: bool):
+        self.command = list(command)
+        self.formats = list(formats)
+        self.processes = processes
+        self.queue_size = queue_size  # conversions waiting for or running in the pool
+        self.timeout = timeout
+        self.prefetch = prefetch and file_cache is not None
+        self.pool = ProcessPoolExecutor(processes)
+        self.jobs = 0
+        self.prefetching = set()
+        self.fallbacks = 0
+        self.converted = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def download(self, book_id: int, file_type: str) -> DownloadResult or CachedFile or None:
+        try:
+            result = await Book.download(book_id, file_type)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if file_type not in self.formats:
+                raise
+            logger.error(f"Download {file_type}_{book_id}: {e!r}")
+            result = None
+        if result is None and file_type in self.formats:
+            self.fallbacks += 1
+            return await self.convert(book_id, file_type)
+        return result
+
+    async def convert(self, book_id: int, file_type: str) -> CachedFile or None:
+        if self.jobs >= self.queue_size:
+            self.rejected += 1
+            return None
+        self.jobs += 1
+        workdir = await run_sync(tempfile.mkdtemp, "", "convert_")
+        others = []
+        try:
+            source = await self._download_source(book_id, workdir)
+            if source is None:
+                return None
+            result = await self._convert(book_id, file_type, source, workdir)
+            if result is not None and self.prefetch:
+                others = [other for other in self.formats if other != file_type]
+            return result
+        finally:
+            self.jobs -= 1
+            if others:
+                task = asyncio.ensure_future(self._prefetch(book_id, others, source, workdir))
+                self.prefetching.add(task)
+                task.add_done_callback(self.prefetching.discard)
+            else:
+                await run_sync(shutil.rmtree, workdir, True)
+
+    async def _download_source(self, book_id: int, workdir: str) -> str or None:  # path of the fb2
+        book_file = await Book.download(book_id, "fb2")
+        if not book_file:
+            return None
+        try:
+            if book_file.too_large:
+                return None
+            path = os.path.join(workdir, f"{book_id}.fb2")
+            await run_sync(write_file, path, book_file.file)
+        finally:
+            book_file.close()
+        return path
+
+    async def _convert(self, book_id: int, file_type: str, source: str, workdir: str) -> CachedFile or None:
+        target = os.path.join(workdir, f"{book_id}.{file_type}")
+        try:
+            with metrics.timed(metrics.CONVERT_SECONDS, "convert", file_type):
+                await asyncio.get_event_loop().run_in_executor(self.pool, run_converter, self.command, source,
+                                                               target, self.timeout)
+            result = await run_sync(store, book_id, file_type, target)
+        except BrokenProcessPool as e:  # a pool process died, the pool doesn't take jobs anymore
+            self.pool = ProcessPoolExecutor(self.processes)
+            self.failed += 1
+            logger.error(f"Convert {file_type}_{book_id}: {e!r}")
+            return None
+        except (subprocess.SubprocessError, OSError, ValueError) as e:  # ValueError: empty output
+            self.failed += 1
+            logger.error(f"Convert {file_type}_{book_id}: {e}")
+            return None
+        except Exception as e:  # the pool failed to run the job at all
+            self.failed += 1
+            logger.exception(f"Convert {file_type}_{book_id}: {e!r}")
+            return None
+        self.converted += 1
+        return result
+
+    async def _prefetch(self, book_id: int, file_types: list, source: str, workdir: str):  # fills the file cache
+        try:
+            for file_type in file_types:
+                if self.jobs >= self.queue_size:  # user requests go first
+                    self.rejected += 1
+                    break
+                if await run_sync(os.path.exists, file_cache.path(book_id, file_type)):
+                    continue
+                self.jobs += 1
+                try:
+                    result = await self._convert(book_id, file_type, source, workdir)
+                finally:
+                    self.jobs -= 1
+                if result is not None:
+                    result.close()
+        finally:
+            await run_sync(shutil.rmtree, workdir, True)
+
+    def close(self):
+        for task in self.prefetching:
+            task.cancel()
+        self.pool.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {"jobs": self.jobs, "fallbacks": self.fallbacks, "converted": self.converted, "failed": self.failed,
+                "rejected": self.rejected}
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.7 on 2026-10-18 12:00
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def remove_duplicates(apps, schema_editor):
+    PostedBook = apps.get_model('db', 'PostedBook')
+    duplicates = (PostedBook.objects.values('book_id', 'file_type')
+                  .annotate(count=Count('file_id')).filter(count__gt=1))
+    for duplicate in duplicates:
+        PostedBook.objects.filter(book_id=duplicate['book_id'], file_type=duplicate['file_type']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0006_auto_20180716_1422'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='postedbook',
+            unique_together={('book_id', 'file_type')},
+        ),
+    ]
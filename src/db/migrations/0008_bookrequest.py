@@ -0,0 +1,26 @@
+# Generated by Django 2.0.7 on 2026-10-18 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0007_postedbook_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.IntegerField()),
+                ('file_type', models.CharField(max_length=4)),
+                ('count', models.IntegerField(default=0)),
+                ('last_requested', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('book_id', 'file_type')},
+            },
+        ),
+    ]
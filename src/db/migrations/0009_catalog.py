@@ -0,0 +1,33 @@
+# Generated by Django 2.0.7 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0008_bookrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogAuthor',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('first_name', models.CharField(max_length=128, null=True)),
+                ('last_name', models.CharField(max_length=128, null=True)),
+                ('middle_name', models.CharField(max_length=128, null=True)),
+                ('name', models.CharField(max_length=400)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CatalogBook',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=512)),
+                ('lang', models.CharField(db_index=True, max_length=8)),
+                ('file_type', models.CharField(max_length=4)),
+                ('authors', models.ManyToManyField(to='db.CatalogAuthor')),
+            ],
+        ),
+    ]
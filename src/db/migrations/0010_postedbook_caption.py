@@ -0,0 +1,18 @@
+# Generated by Django 2.0.7 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db', '0009_catalog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postedbook',
+            name='caption',
+            field=models.TextField(null=True),
+        ),
+    ]
@@ -18,3 +18,33 @@ class PostedBook(models.Model):
     book_id = models.IntegerField(default=False, null=False)
     file_type = models.CharField(max_length=4, default=False, null=False)
     file_id = models.CharField(primary_key=True, max_length=64, default=False, null=False)
+    caption = models.TextField(null=True)  # sent with the file_id, so a posted book needs no metadata
+
+    class Meta:
+        unique_together = (("book_id", "file_type"),)
+
+
+class BookRequest(models.Model):
+    book_id = models.IntegerField()
+    file_type = models.CharField(max_length=4)
+    count = models.IntegerField(default=0)
+    last_requested = models.DateTimeField()
+
+    class Meta:
+        unique_together = (("book_id", "file_type"),)
+
+
+class CatalogAuthor(models.Model):  # local mirror of flibusta_server authors
+    id = models.IntegerField(primary_key=True)
+    first_name = models.CharField(max_length=128, null=True)
+    last_name = models.CharField(max_length=128, null=True)
+    middle_name = models.CharField(max_length=128, null=True)
+    name = models.CharField(max_length=400)
+
+
+class CatalogBook(models.Model):  # local mirror of flibusta_server books
+    id = models.IntegerField(primary_key=True)
+    title = models.CharField(max_length=512)
+    lang = models.CharField(max_length=8, db_index=True)
+    file_type = models.CharField(max_length=4)
+    authors = models.ManyToManyField(CatalogAuthor)
@@ -1,216 +1,283 @@
 import copy
+import functools
 import io
 import json
+import tempfile
 import weakref
 from typing import List
-import requests
+from telebot import logger
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+import catalog
+import config
+import metrics
+from cache import TTLCache
 from config import FLIBUSTA_SERVER
+from file_cache import CachedFile, file_cache
+from http_client import flibusta_client
+from utils import run_sync
+
+search_cache = TTLCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL, config.SEARCH_CACHE_MAX_BYTES)
+CATALOG_ITEM_WEIGHT = 300  # approximate JSON size of a catalog search result, for the search cache weight
+# ("book"|"author", id) -> object
+metadata_cache = TTLCache(config.METADATA_CACHE_SIZE, config.METADATA_CACHE_TTL, config.METADATA_CACHE_MAX_BYTES)
+METADATA_ITEM_WEIGHT = 2000  # approximate memory of a parsed Book, for the metadata cache weight
+MISSING = object()  # negative metadata_cache entry
 
 
 class NoContent(Exception):
     pass
 
 
-class BytesResult(io.BytesIO):
-    def __init__(self, content):
-        super().__init__(content)
-        self.size = len(content)
-        self.name = ""
+async def _lookup(key: tuple, url: str, parse, local=None):  # local is the catalog lookup of the same record
+    result = metadata_cache.get(key)
+    if result is MISSING:
+        raise NoContent
+    if result is not None:
+        return result
+    obj = await run_sync(local) if config.CATALOG_ENABLED and local is not None else None
+    if obj is None:
+        status, content = await flibusta_client.get(url, "lookup")
+        if status == 204:
+            metadata_cache.set(key, MISSING, ttl=config.METADATA_CACHE_MISSING_TTL)
+            raise NoContent
+        obj = json.loads(content)
+    result = parse(obj)
+    metadata_cache.set(key, result, weight=METADATA_ITEM_WEIGHT)
+    return result
 
 
-class Author:
-    def __init__(self, obj: dict):
-        self.obj = obj
+def _remember(items: list):  # books on a shown page are the likely next lookups, their records need no request
+    for item in items:
+        if isinstance(item, Book):
+            metadata_cache.set(("book", item.id), item, weight=METADATA_ITEM_WEIGHT)
 
-    @property
-    def id(self):
-        return self.obj["id"]
 
-    @id.setter
-    def id(self, id_):
-        self.obj["id"] = id_
+async def _search(key: tuple, url: str, parse, local=None) -> list:  # local is the catalog query for the same search
+    result = search_cache.get(key)
+    if result is None and config.CATALOG_ENABLED and local is not None:
+        result = [parse(obj) for obj in await run_sync(local)]
+        search_cache.set(key, result, weight=len(result) * CATALOG_ITEM_WEIGHT)
+    elif result is None:
+        status, content = await flibusta_client.get(url, "search")
+        result = [parse(obj) for obj in json.loads(content)]
+        search_cache.set(key, result, weight=len(content))
+    return result
 
-    @property
-    def first_name(self):
-        return self.obj["first_name"]
 
-    @first_name.setter
-    def first_name(self, first_name):
-        self.obj["first_name"] = first_name
+class Page:
+    __slots__ = ("items", "total", "page", "page_size")
+
+    def __init__(self, items: list, total: int, page: int, page_size: int):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.page_size = page_size
 
     @property
-    def last_name(self):
-        return self.obj["last_name"]
+    def page_count(self) -> int:
+        return max(1, (self.total + self.page_size - 1) // self.page_size)
+
+
+async def _search_page(key: tuple, url: str, parse, page: int, page_size: int, local=None) -> Page:
+    result = await _fetch_page(key, url, parse, page, page_size, local)
+    _remember(result.items)
+    return result
+
+
+async def _fetch_page(key: tuple, url: str, parse, page: int, page_size: int, local=None) -> Page:
+    start = page_size * (page - 1)
+    if config.CATALOG_ENABLED and local is not None:  # the local catalog returns the whole list at once
+        result = await _search(key, url, parse, local)
+        return Page(result[start:start + page_size], len(result), page, page_size)
+    result = search_cache.get(key)
+    if result is not None:
+        return Page(result[start:start + page_size], len(result), page, page_size)
+    page_key = key + (page, page_size)
+    result = search_cache.get(page_key)
+    if result is not None:
+        return result
+    status, content = await flibusta_client.get(f"{url}?page={page}&page_size={page_size}", "search")
+    data = json.loads(content)
+    if isinstance(data, list):  # backend without pagination support returns the full list
+        result = [parse(obj) for obj in data]
+        search_cache.set(key, result, weight=len(content))
+        return Page(result[start:start + page_size], len(result), page, page_size)
+    result = Page([parse(obj) for obj in data["items"]], data["total"], page, page_size)
+    search_cache.set(page_key, result, weight=len(content))
+    return result
+
+
+def share_markup(book_id: int) -> InlineKeyboardMarkup:
+    markup = InlineKeyboardMarkup(row_width=1)
+    markup.add(
+        InlineKeyboardButton("Не открывается!", callback_data=f"remove_cache"),
+        InlineKeyboardButton("Поделиться", switch_inline_query=f"share_{book_id}")
+    )
+    return markup
+
+
+class DownloadResult:
+    def __init__(self, size: int = 0, too_large: bool = False):
+        self.file = io.BytesIO()
+        self.size = size
+        self.too_large = too_large
+        self.name = ""
 
-    @last_name.setter
-    def last_name(self, last_name):
-        self.obj["last_name"] = last_name
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if isinstance(self.file, io.BytesIO) and self.size > config.DOWNLOAD_MEMORY_LIMIT:
+            spool = tempfile.TemporaryFile()
+            spool.write(self.file.getbuffer())
+            self.file.close()
+            self.file = spool
+        self.file.write(chunk)
 
-    @property
-    def middle_name(self):
-        return self.obj["middle_name"]
+    def close(self):
+        self.file.close()
 
-    @middle_name.setter
-    def middle_name(self, middle_name):
-        self.obj["middle_name"] = middle_name
 
-    @property
-    def normal_name(self) -> str:
-        temp = ''
-        if self.last_name:
-            temp = self.last_name
-        if self.first_name:
-            if temp:
-                temp += " "
-            temp += self.first_name
-        if self.middle_name:
-            if temp:
-                temp += " "
-            temp += self.middle_name
-        return temp
+class Author:
+    __slots__ = ("id", "first_name", "last_name", "middle_name", "normal_name", "short", "to_send")
 
-    @property
-    def short(self) -> str:
-        temp = ''
-        if self.last_name:
-            temp += self.last_name
-        if self.first_name:
-            if temp:
-                temp += " "
-            temp += self.first_name[0]
-        if self.middle_name:
-            if temp:
-                temp += " "
-            temp += self.middle_name[0]
-        return temp
+    def __init__(self, obj: dict):
+        self.id = obj["id"]
+        self.first_name = obj["first_name"]
+        self.last_name = obj["last_name"]
+        self.middle_name = obj["middle_name"]
+        self.normal_name = ' '.join(n for n in (self.last_name, self.first_name, self.middle_name) if n)
+        self.short = ' '.join(n for n in (self.last_name, (self.first_name or '')[:1], (self.middle_name or '')[:1])
+                              if n)
+        self.to_send = f'👤 <b>{self.normal_name}</b>\n/a_{self.id}\n\n'
 
-    @property
-    def to_send(self) -> str:
-        return f'👤 <b>{self.normal_name}</b>\n/a_{self.id}\n\n'
+    @staticmethod
+    async def by_id(author_id: int) -> "Author":
+        return await _lookup(("author", author_id), f"{FLIBUSTA_SERVER}/author/{author_id}", Author)
 
     @staticmethod
-    def by_id(author_id: int) -> "Author":
-        response = requests.get(f"{FLIBUSTA_SERVER}/author/{author_id}")
-        if response.status_code == 204:
-            raise NoContent
-        return Author(response.json())
+    async def search(query: str) -> List["Author"]:
+        return await _search(("author_search", query), f"{FLIBUSTA_SERVER}/author/search/{query}", Author,
+                             functools.partial(catalog.search_authors, query))
 
     @staticmethod
-    def search(query: str) -> List["Author"]:
-        response = requests.get(f"{FLIBUSTA_SERVER}/author/search/{query}")
-        return [Author(a) for a in response.json()]
+    async def search_page(query: str, page: int, page_size: int) -> Page:
+        return await _search_page(("author_search", query), f"{FLIBUSTA_SERVER}/author/search/{query}", Author,
+                                  page, page_size, functools.partial(catalog.search_authors, query))
 
 
 class Book:
-    def __init__(self, obj: dict):
-        self.obj = obj
-
-    @property
-    def id(self):
-        return self.obj["id"]
-
-    @id.setter
-    def id(self, id_):
-        self.obj["id"] = id_
-
-    @property
-    def title(self):
-        return self.obj["title"]
-
-    @title.setter
-    def title(self, title):
-        self.obj["title"] = title
-
-    @property
-    def lang(self):
-        return self.obj["lang"]
-
-    @lang.setter
-    def lang(self, lang):
-        self.obj["lang"] = lang
-
-    @property
-    def file_type(self):
-        return self.obj["file_type"]
+    __slots__ = ("id", "title", "lang", "file_type", "authors", "caption", "to_send_book")
 
-    @file_type.setter
-    def file_type(self, file_type):
-        self.obj["file_type"] = file_type
-
-    @property
-    def authors(self):
-        return [Author(a) for a in self.obj["authors"]] if self.obj.get("authors", None) else None
-
-    @authors.setter
-    def authors(self, authors):
-        self.obj["authors"] = authors
-
-    @property
-    def caption(self) -> str:
-        return self.title + '\n' + '\n'.join([author.normal_name for author in self.authors])
+    def __init__(self, obj: dict):
+        self.id = obj["id"]
+        self.title = obj["title"]
+        self.lang = obj["lang"]
+        self.file_type = obj["file_type"]
+        self.authors = [Author(a) for a in obj["authors"]] if obj.get("authors", None) else None
+        author_names = [author.normal_name for author in self.authors or ()]
+        self.caption = self.title + '\n' + '\n'.join(author_names)
+        res = f'<b>{self.title}</b> | {self.lang}\n'
+        if author_names:
+            res += ''.join(f'<b>{name}</b>\n' for name in author_names)
+        else:
+            res += '\n'
+        if self.file_type == 'fb2':
+            self.to_send_book = res + f'⬇ fb2: /fb2_{self.id}\n⬇ epub: /epub_{self.id}\n⬇ mobi: /mobi_{self.id}\n\n'
+        else:
+            self.to_send_book = res + f'⬇ {self.file_type}: /{self.file_type}_{self.id}\n\n'
 
     @property
     def share_markup(self) -> InlineKeyboardMarkup:
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(
-            InlineKeyboardButton("Не открывается!", callback_data=f"remove_cache"),
-            InlineKeyboardButton("Поделиться", switch_inline_query=f"share_{self.id}")
-        )
-        return markup
+        return share_markup(self.id)
 
     def get_download_markup(self, file_type: str) -> InlineKeyboardMarkup:
         markup = InlineKeyboardMarkup()
         markup.row(InlineKeyboardButton('Скачать', url=self.get_download_link(file_type)))
         return markup
 
-    @property
-    def to_send_book(self) -> str:
-        res = f'<b>{self.title}</b> | {self.lang}\n'
-        if self.authors:
-            for a in self.authors:
-                res += f'<b>{a.normal_name}</b>\n'
-        else:
-            res += '\n'
-        if self.file_type == 'fb2':
-            return res + f'⬇ fb2: /fb2_{self.id}\n⬇ epub: /epub_{self.id}\n⬇ mobi: /mobi_{self.id}\n\n'
-        else:
-            return res + f'⬇ {self.file_type}: /{self.file_type}_{self.id}\n\n'
-
     @staticmethod
-    def get_by_id(book_id: int) -> "Book":
-        response = requests.get(f"{FLIBUSTA_SERVER}/book/{book_id}")
-        if response.status_code == 204:
-            raise NoContent
-        return Book(response.json())
+    async def get_by_id(book_id: int) -> "Book":
+        return await _lookup(("book", book_id), f"{FLIBUSTA_SERVER}/book/{book_id}", Book,
+                             functools.partial(catalog.get_book, book_id))
 
     @staticmethod
-    def search(query: str, allowed_langs=None) -> List["Book"]:
+    async def search(query: str, allowed_langs=None) -> List["Book"]:
         if allowed_langs is None:
             allowed_langs = list()
+        key = ("book_search", query, tuple(allowed_langs))
+        local = functools.partial(catalog.search_books, query, allowed_langs)
+        if allowed_langs:
+            return await _search(key, f"{FLIBUSTA_SERVER}/book/search/{query}/{json.dumps(allowed_langs)}", Book,
+                                 local)
+        return await _search(key, f"{FLIBUSTA_SERVER}/book/search/{query}", Book, local)
+
+    @staticmethod
+    async def search_page(query: str, allowed_langs, page: int, page_size: int) -> Page:
+        key = ("book_search", query, tuple(allowed_langs))
         if allowed_langs:
-            response = requests.get(f"{FLIBUSTA_SERVER}/book/search/{query}/{json.dumps(allowed_langs)}")
+            url = f"{FLIBUSTA_SERVER}/book/search/{query}/{json.dumps(allowed_langs)}"
         else:
-            response = requests.get(f"{FLIBUSTA_SERVER}/book/search/{query}")
-        return [Book(b) for b in response.json()]
+            url = f"{FLIBUSTA_SERVER}/book/search/{query}"
+        return await _search_page(key, url, Book, page, page_size,
+                                  functools.partial(catalog.search_books, query, allowed_langs))
 
     @staticmethod
-    def by_author(author_id: int, allowed_langs=None) -> List["Book"]:
+    async def by_author(author_id: int, allowed_langs=None) -> List["Book"]:
         if allowed_langs is None:
             allowed_langs = list()
+        key = ("book_author", author_id, tuple(allowed_langs))
+        local = functools.partial(catalog.books_by_author, author_id, allowed_langs)
         if allowed_langs:
-            response = requests.get(f"{FLIBUSTA_SERVER}/book/author/{author_id}/{json.dumps(allowed_langs)}")
+            return await _search(key, f"{FLIBUSTA_SERVER}/book/author/{author_id}/{json.dumps(allowed_langs)}", Book,
+                                 local)
+        return await _search(key, f"{FLIBUSTA_SERVER}/book/author/{author_id}", Book, local)
+
+    @staticmethod
+    async def by_author_page(author_id: int, allowed_langs, page: int, page_size: int) -> Page:
+        key = ("book_author", author_id, tuple(allowed_langs))
+        if allowed_langs:
+            url = f"{FLIBUSTA_SERVER}/book/author/{author_id}/{json.dumps(allowed_langs)}"
         else:
-            response = requests.get(f"{FLIBUSTA_SERVER}/book/author/{author_id}")
-        return [Book(b) for b in response.json()]
+            url = f"{FLIBUSTA_SERVER}/book/author/{author_id}"
+        return await _search_page(key, url, Book, page, page_size,
+                                  functools.partial(catalog.books_by_author, author_id, allowed_langs))
 
     def get_download_link(self, file_type: str) -> str:
         return f"{FLIBUSTA_SERVER}/book/download/{self.id}/{file_type}"
 
     @staticmethod
-    def download(book_id: int, file_type: str) -> BytesResult or None:
-        r = requests.get(f"{FLIBUSTA_SERVER}/book/download/{book_id}/{file_type}")
-        if r.status_code != 200:
-            return None
-        return BytesResult(r.content)
+    async def download(book_id: int, file_type: str) -> DownloadResult or CachedFile or None:
+        if file_cache is not None:
+            cached = await run_sync(file_cache.get, book_id, file_type)
+            if cached is not None:
+                return cached
+        with metrics.timed(metrics.FLIBUSTA_SECONDS, "flibusta", "download"):
+            result = await Book._download(book_id, file_type)
+        if file_cache is not None and result is not None and not result.too_large:
+            try:
+                await run_sync(file_cache.put, book_id, file_type, result.file)
+            except OSError as e:
+                logger.error(f"File cache {file_type}_{book_id}: {e}")
+            result.file.seek(0)
+        return result
+
+    @staticmethod
+    async def _download(book_id: int, file_type: str) -> DownloadResult or None:
+        response = await flibusta_client.open(f"{FLIBUSTA_SERVER}/book/download/{book_id}/{file_type}", "download")
+        async with response:
+            if response.status != 200:
+                return None
+            if response.content_length and response.content_length > config.DOWNLOAD_MAX_SIZE:
+                return DownloadResult(response.content_length, too_large=True)
+            result = DownloadResult()
+            try:
+                async for chunk in response.content.iter_chunked(config.DOWNLOAD_CHUNK_SIZE):
+                    result.write(chunk)
+                    if result.size > config.DOWNLOAD_MAX_SIZE:
+                        result.too_large = True
+                        break
+            except BaseException:
+                result.close()
+                raise
+        result.file.seek(0)
+        return result
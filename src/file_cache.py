@@ -0,0 +1,128 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+
+import config
+
+TMP_PREFIX = ".tmp"
+SIZE_FILE = ".size"  # total size of the cached files, shared by all processes under flock
+
+
+class CachedFile:  # read-only mmap of a cached book, UploadPayload streams it from the page cache in chunks
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file = memoryview(self._mmap)
+        self.size = len(self._mmap)
+        self.too_large = False
+        self.name = ""
+
+    def close(self):
+        self.file.release()
+        try:
+            self._mmap.close()
+        except BufferError:  # still referenced by the upload, unmapped when collected
+            pass
+
+
+class FileCache:  # book files on disk, shared by all bot processes on the host, evicts least recently used
+    def __init__(self, directory: str, max_bytes: int, evict_to: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to  # share of max_bytes left after an eviction
+        self.size = None  # bytes on disk as of the last write of this process
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, book_id: int, file_type: str) -> str:
+        digest = hashlib.sha1(f"{book_id}_{file_type}".encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:4], f"{digest}.{file_type}")
+
+    def get(self, book_id: int, file_type: str) -> CachedFile or None:
+        path = self.path(book_id, file_type)
+        try:
+            os.utime(path)  # mtime is the recency for eviction
+            cached = CachedFile(path)
+        except (FileNotFoundError, ValueError):  # ValueError: an empty file can't be mapped
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached
+
+    def put(self, book_id: int, file_type: str, file):
+        path = self.path(book_id, file_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(file, out)
+                size = out.tell()
+            try:
+                size -= os.stat(path).st_size  # written by another process meanwhile
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)  # readers see the whole file or none
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._account(size)
+
+    def _account(self, added: int):
+        fd = os.open(os.path.join(self.directory, SIZE_FILE), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)  # also keeps evictions of different processes apart
+            try:
+                size = int(os.read(fd, 32)) + added
+            except ValueError:  # no counter yet, the scan already sees the new file
+                size = sum(entry[1] for entry in self._entries())
+            if size > self.max_bytes:
+                size = self._evict()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(size).encode())
+            self.size = size
+        finally:
+            os.close(fd)
+
+    def _entries(self) -> list:  # (path, size, mtime)
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith("."):  # files being written and the size counter
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self) -> int:  # rescans the directory, so the counter catches up with files removed by hand
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(entry[1] for entry in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes * self.evict_to:
+                break
+            try:
+                os.unlink(path)  # open mmaps keep the data until they are closed
+                self.evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def stats(self) -> dict:
+        return {"size": self.size, "hits": self.hits, "misses": self.misses, "evicted": self.evicted}
+
+
+file_cache = (FileCache(config.FILE_CACHE_DIR, config.FILE_CACHE_MAX_BYTES, config.FILE_CACHE_EVICT_TO)
+              if config.FILE_CACHE_DIR else None)
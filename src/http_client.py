@@ -0,0 +1,73 @@
+import asyncio
+import random
+
+import aiohttp
+
+import config
+import metrics
+
+
+class HTTPClient:
+    def __init__(self, pool_size: int, keepalive_timeout: float, timeouts: dict, retries: int, backoff: float):
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.timeouts = {endpoint: aiohttp.ClientTimeout(connect=connect, sock_read=read)
+                         for endpoint, (connect, read) in timeouts.items()}
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None  # type: aiohttp.ClientSession
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _sleep_before_retry(self, attempt: int):  # exponential backoff with full jitter
+        await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def open(self, url: str, endpoint: str) -> aiohttp.ClientResponse:  # caller must release the response
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self.session.get(url, timeout=self.timeouts[endpoint])
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await self._sleep_before_retry(attempt)
+                continue
+            if response.status >= 500 and attempt < self.retries:
+                response.release()
+                await self._sleep_before_retry(attempt)
+                continue
+            return response
+
+    async def get(self, url: str, endpoint: str) -> (int, bytes):
+        with metrics.timed(metrics.FLIBUSTA_SECONDS, "flibusta", endpoint):
+            return await self._get(url, endpoint)
+
+    async def _get(self, url: str, endpoint: str) -> (int, bytes):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.get(url, timeout=self.timeouts[endpoint]) as response:
+                    if response.status >= 500 and attempt < self.retries:
+                        await self._sleep_before_retry(attempt)
+                        continue
+                    return response.status, await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await self._sleep_before_retry(attempt)
+
+
+flibusta_client = HTTPClient(
+    pool_size=config.FLIBUSTA_POOL_SIZE,
+    keepalive_timeout=config.FLIBUSTA_KEEPALIVE_TIMEOUT,
+    timeouts=config.FLIBUSTA_TIMEOUTS,
+    retries=config.FLIBUSTA_RETRIES,
+    backoff=config.FLIBUSTA_RETRY_BACKOFF
+)
@@ -0,0 +1,112 @@
+import asyncio
+import re
+
+from telebot.types import (InlineQuery, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle,
+                           InlineQueryResultCachedDocument, InputTextMessageContent)
+
+import config
+from bot import AsyncBot
+from filbusta_server import Book, NoContent, search_cache
+from send import Sender
+from singleflight import SingleFlight
+from users import user_settings
+
+BOT_LINK = f"https://t.me/{config.BOT_NAME}"
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def book_file_types(book: Book) -> tuple:
+    return ("fb2", "epub", "mobi") if book.file_type == "fb2" else (book.file_type,)
+
+
+def book_article(book: Book) -> InlineQueryResultArticle:
+    markup = InlineKeyboardMarkup()
+    markup.row(*[InlineKeyboardButton(f"⬇ {file_type}", url=f"{BOT_LINK}?start={file_type}_{book.id}")
+                 for file_type in book_file_types(book)])
+    authors = ", ".join(author.short for author in book.authors or ())
+    return InlineQueryResultArticle(str(book.id), book.title, InputTextMessageContent(book.caption),
+                                    reply_markup=markup, description=f"{authors} | {book.lang}")
+
+
+def matches(book: Book, words: list) -> bool:
+    text = (book.caption + " " + " ".join(author.short for author in book.authors or ())).lower()
+    return all(word in text for word in words)
+
+
+class InlineSearch:  # a newer query of the same user cancels the one still being answered
+    def __init__(self, bot: AsyncBot, sender: Sender, page_size: int, cache_time: int, min_query_length: int):
+        self.bot = bot
+        self.sender = sender
+        self.page_size = page_size
+        self.cache_time = cache_time
+        self.min_query_length = min_query_length
+        self.running = {}  # user_id -> asyncio.Future
+        self.searches = SingleFlight()  # a cancelled keystroke leaves its backend search running for the next one
+        self.cancelled = 0
+        self.prefix_hits = 0
+
+    async def answer(self, query: InlineQuery):
+        user_id = query.from_user.id
+        previous = self.running.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        task = self.running[user_id] = asyncio.ensure_future(self._answer(query))
+        try:
+            await asyncio.wait([task])
+        finally:
+            if self.running.get(user_id) is task:
+                del self.running[user_id]
+        if task.cancelled():
+            self.cancelled += 1
+            return
+        task.result()
+
+    async def _answer(self, query: InlineQuery):
+        share = re.search(r'^share_([0-9]+)$', query.query.strip())
+        if share:
+            results = await self._share(int(share.group(1)))
+            return await self.bot.answer_inline_query(query.id, results, cache_time=self.cache_time)
+        text = normalize_query(query.query)
+        if len(text) < self.min_query_length:
+            return await self.bot.answer_inline_query(query.id, [], cache_time=self.cache_time)
+        books = await self._search(text, await user_settings.get_allowed_langs(query.from_user.id))
+        offset = int(query.offset) if query.offset.isdigit() else 0
+        next_offset = str(offset + self.page_size) if offset + self.page_size < len(books) else ""
+        results = [book_article(book) for book in books[offset:offset + self.page_size]]
+        await self.bot.answer_inline_query(query.id, results, cache_time=self.cache_time, is_personal=True,
+                                           next_offset=next_offset)
+
+    async def _search(self, text: str, allowed_langs: tuple) -> list:
+        if search_cache.get(("book_search", text, allowed_langs)) is None:
+            # every keystroke extends the previous query, narrow down a cached result of a prefix when there is one
+            words = text.split()
+            for end in range(len(text) - 1, self.min_query_length - 1, -1):
+                prefix = search_cache.get(("book_search", text[:end].rstrip(), allowed_langs))
+                if prefix is not None:
+                    books = [book for book in prefix if matches(book, words)]
+                    if books:
+                        self.prefix_hits += 1
+                        return books
+                    break
+        books, _ = await self.searches.do(("book_search", text, allowed_langs), Book.search, text, list(allowed_langs))
+        return books
+
+    async def _share(self, book_id: int) -> list:
+        try:
+            book = await Book.get_by_id(book_id)
+        except NoContent:
+            return []
+        results = []
+        for file_type in book_file_types(book):
+            file_id = await self.sender.get_file_id(book.id, file_type)
+            if file_id is not None:
+                results.append(InlineQueryResultCachedDocument(f"{file_type}_{book.id}", file_id,
+                                                               f"{book.title} ({file_type})", caption=book.caption))
+        results.append(book_article(book))
+        return results
+
+    def stats(self) -> dict:
+        return {"running": len(self.running), "cancelled": self.cancelled, "prefix_hits": self.prefix_hits}
@@ -1,77 +1,112 @@
+import asyncio
 import os
 import re
 import time
 
-from telebot import AsyncTeleBot
 import telebot.types as ttypes
 import analytics
+import catalog
 
 from aiohttp import web
 
 import config
+import metrics
 import strings
-from send import Sender
+from bot import AsyncBot
+from convert import Converter
+from file_cache import file_cache
+from filbusta_server import metadata_cache
+from http_client import flibusta_client
+from inline import InlineSearch
+from ratelimit import SendScheduler
+from prewarm import Prewarmer
+from send import Sender, BookRequestCounter
+from users import UserWriter, user_settings
+from utils import run_sync
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
 
 from django.core.wsgi import get_wsgi_application
+from django.db.backends.signals import connection_created
 
 application = get_wsgi_application()
+connection_created.connect(metrics.instrument_connection)
 
 from db.models import TelegramUser, Settings
-from django.db.models import ObjectDoesNotExist
 
 
-bot = AsyncTeleBot(config.BOT_TOKEN, num_threads=4)
-sender = Sender(bot)
+scheduler = SendScheduler(config.TELEGRAM_GLOBAL_RATE, config.TELEGRAM_CHAT_RATE, config.TELEGRAM_GROUP_RATE,
+                          config.TELEGRAM_CHAT_BURST)
+
+
+def superseded_key(update: ttypes.Update):  # only the latest page flip or inline query is worth handling
+    query = update.callback_query
+    if query is not None and query.message is not None and re.search(r'^(b|a|ba)_[0-9]+$', query.data or ''):
+        return query.message.chat.id, query.message.message_id
+    if update.inline_query is not None:
+        return "inline", update.inline_query.from_user.id
+    return None
+
+
+bot = AsyncBot(config.BOT_TOKEN, max_concurrent_updates=config.MAX_CONCURRENT_UPDATES, scheduler=scheduler,
+               max_retries=config.TELEGRAM_MAX_RETRIES, queue_size=config.INTAKE_QUEUE_SIZE,
+               overflow_policy=config.INTAKE_OVERFLOW_POLICY, superseded_key=superseded_key,
+               api_url=config.TELEGRAM_API_URL, slow_update_threshold=config.SLOW_UPDATE_THRESHOLD)
+book_requests = BookRequestCounter(config.BOOK_REQUESTS_FLUSH_INTERVAL)
+converter = (Converter(config.CONVERT_COMMAND, config.CONVERT_FORMATS, config.CONVERT_PROCESSES,
+                       config.CONVERT_QUEUE_SIZE, config.CONVERT_TIMEOUT, config.CONVERT_PREFETCH)
+             if config.CONVERT_ENABLED else None)
+sender = Sender(bot, book_requests, converter)
+inline_search = InlineSearch(bot, sender, config.INLINE_PAGE_SIZE, config.INLINE_CACHE_TIME,
+                             config.INLINE_MIN_QUERY_LENGTH)
+prewarmer = Prewarmer(sender, config.PREWARM_CHAT_ID, config.PREWARM_CONCURRENCY, config.PREWARM_BUDGET,
+                      config.PREWARM_TOP, config.PREWARM_INTERVAL, config.PREWARM_BOOKS)
+user_writer = UserWriter(config.USER_CACHE_SIZE, config.USER_CACHE_TTL, config.USER_FLUSH_INTERVAL,
+                         config.USER_FLUSH_BATCH_SIZE)
+
+metrics.Gauge("bot_intake_queue_length", "Updates waiting for a handler", lambda: bot.stats()["queue_length"])
+metrics.Gauge("bot_send_queue_length", "Bot API calls waiting for a rate limit token",
+              lambda: sum(scheduler.stats()["queue_depth"].values()))
+metrics.Gauge("bot_analytics_queue_length", "Analytics events waiting for the sink",
+              lambda: analytics.pipeline.stats()["queued"])
 
 
 def update_user(msg: ttypes.Message):
-    try:
-        user = TelegramUser.objects.get(user_id=msg.from_user.id)
-        user.first_name = msg.from_user.first_name
-        user.last_name = msg.from_user.last_name
-        user.username = msg.from_user.username
-    except ObjectDoesNotExist:
-        user = TelegramUser.objects.create(
-            user_id=msg.from_user.id, first_name=msg.from_user.first_name, 
-            last_name=msg.from_user.last_name, username=msg.from_user.username
-        )
-    user.save()
+    user_writer.update(msg.from_user)
 
 
 @bot.message_handler(commands=["start"])
-def start_handler(msg: ttypes.Message):
+async def start_handler(msg: ttypes.Message):
     update_user(msg)
     try:
         file_type, book_id = (msg.text.split(' ')[1].split("_"))
-        sender.send_book(msg, int(book_id), file_type)
+        await sender.send_book(msg, int(book_id), file_type)
         analytics._analyze(msg.text, "get_shared_book", msg.from_user.id)
     except (ValueError, IndexError):
-        bot.reply_to(msg, strings.start_message.format(name=msg.from_user.first_name))
+        await bot.reply_to(msg, strings.start_message.format(name=msg.from_user.first_name))
         analytics._analyze(msg.text, "start", msg.from_user.id)
 
 
 @bot.message_handler(commands=["help"])
 @analytics.analyze("help")
-def help_handler(msg: ttypes.Message):
-    bot.reply_to(msg, strings.help_msg)
+async def help_handler(msg: ttypes.Message):
+    await bot.reply_to(msg, strings.help_msg)
 
 
 @bot.message_handler(commands=["info"])
 @analytics.analyze("info")
-def info_handler(msg: ttypes.Message):
-    bot.reply_to(msg, strings.info_msg, disable_web_page_preview=True)
+async def info_handler(msg: ttypes.Message):
+    await bot.reply_to(msg, strings.info_msg, disable_web_page_preview=True)
 
 
 @bot.message_handler(commands=["vote"])
 @analytics.analyze("vote")
-def vote_handler(msg: ttypes.Message):
-    bot.reply_to(msg, strings.vote_msg)
+async def vote_handler(msg: ttypes.Message):
+    await bot.reply_to(msg, strings.vote_msg)
 
 
 def make_settings_keyboard(user_id: int) -> ttypes.InlineKeyboardMarkup:
-    user = TelegramUser.objects.get(user_id=user_id)
+    user = TelegramUser.objects.select_related("settings").get(user_id=user_id)
     if user.settings is None:
         user.settings = Settings.objects.create()
         user.settings.save()
@@ -88,104 +123,119 @@ def make_settings_keyboard(user_id: int) -> ttypes.InlineKeyboardMarkup:
     return keyboard
 
 
+def change_settings(user_id: int, lang: str, value: bool):
+    user = TelegramUser.objects.select_related("settings").get(user_id=user_id)
+    if lang == "uk":
+        user.settings.allow_uk = value
+    elif lang == "be":
+        user.settings.allow_be = value
+    user.settings.save()
+
+
 @bot.message_handler(commands=["settings"])
 @analytics.analyze("settings")
-def settings(msg: ttypes.Message):
-    update_user(msg)
-    bot.reply_to(msg, "Настройки: ", reply_markup=make_settings_keyboard(msg.from_user.id))
+async def settings(msg: ttypes.Message):
+    await user_writer.save(msg.from_user)  # make_settings_keyboard needs the user row
+    keyboard = await run_sync(make_settings_keyboard, msg.from_user.id)
+    user_settings.invalidate(msg.from_user.id)  # settings row may have just been created
+    await bot.reply_to(msg, "Настройки: ", reply_markup=keyboard)
 
 
 @bot.callback_query_handler(func=lambda x: re.search(r"^(uk|be)_(on|off)$", x.data) is not None)
 @analytics.analyze("settings_change")
-def lang_setup(query: ttypes.CallbackQuery):
-    user = TelegramUser.objects.get(user_id=query.from_user.id)
+async def lang_setup(query: ttypes.CallbackQuery):
     lang, set_ = query.data.split('_')
-    if lang == "uk":
-        user.settings.allow_uk = (set_ == "on")
-    elif lang == "be":
-        user.settings.allow_be = (set_ == "on")
-    user.settings.save()
-    keyboard = make_settings_keyboard(query.from_user.id)
-    bot.edit_message_reply_markup(chat_id=query.message.chat.id, message_id=query.message.message_id,
-                                  reply_markup=keyboard)
+    await run_sync(change_settings, query.from_user.id, lang, set_ == "on")
+    user_settings.invalidate(query.from_user.id)
+    keyboard = await run_sync(make_settings_keyboard, query.from_user.id)
+    await bot.edit_message_reply_markup(chat_id=query.message.chat.id, message_id=query.message.message_id,
+                                        reply_markup=keyboard)
 
 
 @bot.message_handler(regexp='/a_([0-9])+')
 @analytics.analyze("get_books_by_author")
-def search_books_by_author(msg: ttypes.Message):
+async def search_books_by_author(msg: ttypes.Message):
     update_user(msg)
-    sender.search_books_by_author(msg, int(msg.text.split('_')[1]), 1)
+    await sender.search_books_by_author(msg, int(msg.text.split('_')[1]), 1)
 
 
 @bot.message_handler(commands=['donate'])
 @analytics.analyze("donation")
-def donation(msg: ttypes.Message):
-    bot.reply_to(msg, strings.donate_msg, parse_mode='HTML')
+async def donation(msg: ttypes.Message):
+    await bot.reply_to(msg, strings.donate_msg, parse_mode='HTML')
 
 
 @bot.message_handler(regexp='^/(fb2|epub|mobi|djvu|pdf|doc)_[0-9]+$')
 @analytics.analyze("download")
-def get_book_handler(msg: ttypes.Message):
+async def get_book_handler(msg: ttypes.Message):
     file_type, book_id = msg.text.replace('/', '').split('_')
-    sender.send_book(msg, int(book_id), file_type)
+    await sender.send_book(msg, int(book_id), file_type)
 
 
 @bot.message_handler(func=lambda message: True)
 @analytics.analyze("new_search_query")
-def search(msg: ttypes.Message):
+async def search(msg: ttypes.Message):
     update_user(msg)
     keyboard = ttypes.InlineKeyboardMarkup()
     keyboard.add(
         ttypes.InlineKeyboardButton("По названию", callback_data="b_1"),
         ttypes.InlineKeyboardButton("По авторам", callback_data="a_1")
         )
-    bot.reply_to(msg, "Поиск: ", reply_markup=keyboard)
+    await bot.reply_to(msg, "Поиск: ", reply_markup=keyboard)
 
 
 @bot.callback_query_handler(func=lambda x: re.search(r'^b_([0-9]+)', x.data) is not None)
 @analytics.analyze("search_book_by_title")
-def search_books_by_title(callback: ttypes.CallbackQuery):
+async def search_books_by_title(callback: ttypes.CallbackQuery):
     msg: ttypes.Message = callback.message
     if not msg.reply_to_message or not msg.reply_to_message.text:
-        return bot.send_message("Ошибка :( Попробуйте еще раз!")
-    sender.search_books(msg, int(callback.data.split('_')[1]))
+        return await bot.send_message(msg.chat.id, "Ошибка :( Попробуйте еще раз!")
+    await sender.search_books(msg, int(callback.data.split('_')[1]))
 
 
 @bot.callback_query_handler(func=lambda x: re.search(r'^a_([0-9])+', x.data) is not None)
 @analytics.analyze("search_authors")
-def search_authors(callback: ttypes.CallbackQuery):
+async def search_authors(callback: ttypes.CallbackQuery):
     msg: ttypes.Message = callback.message
     if not msg.reply_to_message or not msg.reply_to_message.text:
-        return bot.send_message("Ошибка :( Попробуйте еще раз!")
-    sender.search_authors(msg, int(callback.data.split('_')[1]))
+        return await bot.send_message(msg.chat.id, "Ошибка :( Попробуйте еще раз!")
+    await sender.search_authors(msg, int(callback.data.split('_')[1]))
 
 
 @bot.callback_query_handler(func=lambda x: re.search(r'^ba_([0-9]+)', x.data) is not None)
 @analytics.analyze("get_books_by_author")
-def get_books_by_author(callback: ttypes.CallbackQuery):
+async def get_books_by_author(callback: ttypes.CallbackQuery):
     msg: ttypes.Message = callback.message
     if not msg.reply_to_message or not msg.reply_to_message.text:
-        return bot.send_message("Ошибка :( Попробуйте еще раз!")
+        return await bot.send_message(msg.chat.id, "Ошибка :( Попробуйте еще раз!")
     update_user(msg.reply_to_message)
-    sender.search_books_by_author(msg, int(msg.reply_to_message.text.split('_')[1]), int(callback.data.split('_')[1]))
+    await sender.search_books_by_author(msg, int(msg.reply_to_message.text.split('_')[1]),
+                                        int(callback.data.split('_')[1]))
 
 
 @bot.callback_query_handler(
     func=lambda x: re.search(r'remove_cache', x.data) is not None)
 @analytics.analyze("remove_cache")
-def remove_cache(callback: ttypes.CallbackQuery):
-    msg = bot.send_message(callback.from_user.id, strings.cache_removed)
+async def remove_cache(callback: ttypes.CallbackQuery):
+    await bot.send_message(callback.from_user.id, strings.cache_removed)
     reply_to: ttypes.Message = callback.message.reply_to_message
     file_type, book_id = reply_to.text.replace('/', '').split('_')
-    sender.remove_cache(file_type, int(book_id))
-    msg.wait()
-    sender.send_book(reply_to, int(book_id), file_type)
+    await sender.remove_cache(file_type, int(book_id))
+    await sender.send_book(reply_to, int(book_id), file_type)
+
+
+@bot.inline_handler(func=lambda query: True)
+async def inline_query(query: ttypes.InlineQuery):
+    if not query.offset:  # next pages of the same query are not new searches
+        analytics._analyze(query.query, "inline_search", query.from_user.id)
+    await inline_search.answer(query)
 
 
 async def handle(request):
     if request.match_info.get('token') == bot.token:
         request_body_dict = await request.json()
-        bot.process_new_updates([ttypes.Update.de_json(request_body_dict)])
+        if not bot.enqueue(ttypes.Update.de_json(request_body_dict)):
+            return web.Response(status=config.INTAKE_OVERFLOW_STATUS)
         global last_update
         last_update = time.time()
         return web.Response()
@@ -193,19 +243,82 @@ async def handle(request):
         return web.Response(status=403)
 
 
-if __name__ == "__main__":
-    bot.remove_webhook()
+async def stats(request):
+    if request.match_info.get('token') == bot.token:
+        return web.json_response({"intake": bot.stats(), "scheduler": scheduler.stats(), "prewarm": prewarmer.stats(),
+                                  "inline": inline_search.stats(),
+                                  "metadata_cache": metadata_cache.stats(),
+                                  "file_cache": file_cache.stats() if file_cache is not None else None,
+                                  "convert": converter.stats() if converter is not None else None})
+    else:
+        return web.Response(status=403)
+
+
+async def metrics_handler(request):
+    if request.match_info.get('token') == bot.token:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    else:
+        return web.Response(status=403)
 
-    app = web.Application()
-    app.router.add_post('/{token}/', handle)
 
-    WEBHOOK_URL_BASE = config.WEBHOOK_HOST
-    WEBHOOK_URL_PATH = "/{}/".format(config.BOT_TOKEN)
+async def on_startup(app):
+    if app["worker"] is None:  # in cluster mode the front process owns the webhook
+        await bot.remove_webhook()
+        if config.RUN_MODE == "polling":
+            app["polling"] = asyncio.ensure_future(bot.polling(config.POLLING_LIMIT, config.POLLING_TIMEOUT))
+        else:
+            WEBHOOK_URL_BASE = config.WEBHOOK_HOST
+            WEBHOOK_URL_PATH = "/{}/".format(config.BOT_TOKEN)
+
+            await bot.set_webhook(url=WEBHOOK_URL_BASE+WEBHOOK_URL_PATH)
+    app["user_writer"] = asyncio.ensure_future(user_writer.run())
+    app["analytics"] = asyncio.ensure_future(analytics.pipeline.run())
+    app["book_requests"] = asyncio.ensure_future(book_requests.run())
+    if config.PREWARM_ENABLED and app["worker"] in (None, 0):  # one prewarmer per cluster
+        app["prewarm"] = asyncio.ensure_future(prewarmer.run())
+    if config.CATALOG_ENABLED and config.CATALOG_REFRESH_INTERVAL and app["worker"] in (None, 0):
+        app["catalog_refresh"] = asyncio.ensure_future(catalog.refresh_loop())
+
+
+async def on_cleanup(app):
+    if "polling" in app:
+        app["polling"].cancel()
+    app["user_writer"].cancel()
+    await user_writer.flush()
+    app["analytics"].cancel()
+    app["book_requests"].cancel()
+    await book_requests.flush()
+    if "prewarm" in app:
+        app["prewarm"].cancel()
+    if "catalog_refresh" in app:
+        app["catalog_refresh"].cancel()
+    if converter is not None:
+        converter.close()
+    await analytics.pipeline.close()
+    await bot.close()
+    await flibusta_client.close()
+
+
+def make_app(worker: int = None) -> web.Application:  # worker is the process index in cluster mode
+    app = web.Application()
+    app["worker"] = worker
+    if worker is not None or config.RUN_MODE != "polling":
+        app.router.add_post('/{token}/', handle)
+    app.router.add_get('/{token}/stats', stats)
+    if config.METRICS_ENABLED:
+        app.router.add_get('/{token}/metrics', metrics_handler)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
 
-    bot.set_webhook(url=WEBHOOK_URL_BASE+WEBHOOK_URL_PATH)
 
-    web.run_app(
-        app,
-        host=config.SERVER_HOST,
-        port=config.SERVER_PORT
-    )
+if __name__ == "__main__":
+    if config.WORKER_PROCESSES > 1:
+        import cluster
+        cluster.run()
+    else:
+        web.run_app(
+            make_app(),
+            host=config.SERVER_HOST,
+            port=config.SERVER_PORT
+        )
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+_thread = threading.local()  # trace of the update served by an executor thread
+_traces = {}  # asyncio.Task -> Trace
+_current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+
+
+def _register(metric):  # by name, importing main twice (as __main__ and main in cluster workers) replaces it
+    _metrics[:] = [other for other in _metrics if other.name != metric.name]
+    _metrics.append(metric)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.values = {}  # label values -> count
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:  # value is read at scrape time
+    def __init__(self, name: str, help_: str, func):
+        self.name = name
+        self.help = help_
+        self.func = func
+        _register(self)
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.func()}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help_: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            row = self.values.get(label_values)
+            if row is None:
+                row = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, row in sorted(self.values.items()):
+            for bound, count in zip(self.buckets + ("+Inf",), row[:-2] + row[-1:]):
+                le = 'le="' + str(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {row[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {row[-1]}")
+        return lines
+
+
+def render() -> str:  # Prometheus text exposition format
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+
+UPDATES = Counter("bot_updates_total", "Handled updates", ("handler", "status"))
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Time spent in update handlers", ("handler",))
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_seconds", "Telegram Bot API request time", ("method",))
+TELEGRAM_ERRORS = Counter("bot_telegram_errors_total", "Unsuccessful Telegram Bot API requests", ("method", "code"))
+RATE_LIMIT_SECONDS = Histogram("bot_rate_limit_wait_seconds", "Wait for a send rate limit token")
+FLIBUSTA_SECONDS = Histogram("bot_flibusta_request_seconds", "flibusta_server request time", ("endpoint",))
+DB_QUERY_SECONDS = Histogram("bot_db_query_seconds", "Database query time")
+CONVERT_SECONDS = Histogram("bot_convert_seconds", "Local fb2 conversion time", ("format",))
+
+
+class Trace:  # per-stage time of one update
+    __slots__ = ("update_id", "stages")
+
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+        self.stages = {}  # stage -> [seconds, calls]
+
+    def add(self, stage: str, seconds: float):
+        stat = self.stages.setdefault(stage, [0.0, 0])
+        stat[0] += seconds
+        stat[1] += 1
+
+    def format(self) -> str:
+        return ", ".join(f"{stage} {seconds:.3f}s/{calls}"
+                         for stage, (seconds, calls) in sorted(self.stages.items(), key=lambda s: -s[1][0]))
+
+
+def current_trace() -> Trace or None:
+    trace = getattr(_thread, "trace", None)
+    if trace is not None:
+        return trace
+    try:
+        return _traces.get(_current_task())
+    except RuntimeError:  # executor thread without a bound trace
+        return None
+
+
+def bind_thread(trace: Trace or None):
+    _thread.trace = trace
+
+
+@contextmanager
+def trace_update(update_id: int):
+    task = _current_task()
+    trace = _traces[task] = Trace(update_id)
+    try:
+        yield trace
+    finally:
+        del _traces[task]
+
+
+def share_trace(task: asyncio.Future):  # a task spawned by the handler reports into the same trace
+    trace = current_trace()
+    if trace is not None:
+        _traces[task] = trace
+        task.add_done_callback(lambda _: _traces.pop(task, None))
+
+
+@contextmanager
+def timed(histogram: Histogram, stage: str, *label_values):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - started
+        histogram.observe(seconds, *label_values)
+        trace = current_trace()
+        if trace is not None:
+            trace.add(stage, seconds)
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    with timed(DB_QUERY_SECONDS, "db"):
+        return execute(sql, params, many, context)
+
+
+def instrument_connection(sender, connection, **kwargs):  # connect to django connection_created
+    connection.execute_wrappers.append(db_execute_wrapper)
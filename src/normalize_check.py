@@ -0,0 +1,71 @@
+import random
+import sys
+
+import transliterate as transliterate
+
+from filbusta_server import Book
+from send import filenames, normalize
+
+# Checks that send.normalize gives exactly the filenames of its original implementation, run it after changing
+# FILENAME_TABLE or the transliterate version: python normalize_check.py [samples] [seed]
+
+TITLES = ["Война и мир", "Преступление и наказание ", "Мастер и Маргарита", "Что делать?", "«Слово о полку Игореве»",
+          "Собачье сердце: повесть", "Записки из подполья (1864)", "Ёжик в тумане…", "Щит и меч — том 1/2",
+          "Гарри Поттер и узник Азкабана", "№ 13", "Âme d'á côté", "Über\xa0alles", "Їжак та Ґава", "Ѣ і ѳ"]
+AUTHORS = [("Лев", "Толстой", "Николаевич"), ("Фёдор", "Достоевский", "Михайлович"), ("", "Гомер", ""),
+           ("Джоан", "Роулинг", ""), ("O'", "Henry", "")]
+ALPHABET = ([chr(code) for code in range(0x0400, 0x0530)] + list("abcxyzABCXYZ0189 -_.,")
+            + list("(),….’!\"?»«':—/№ –á\xa0") + ["\U0001d538", "№", "é"])
+
+
+def reference_normalize(book: Book, file_type: str) -> str:  # send.normalize before the translate table
+    filename = '_'.join([a.short for a in book.authors]) + '_-_' if book.authors else ''
+    filename += book.title if book.title[-1] != ' ' else book.title[:-1]
+    filename = transliterate.translit(filename, 'ru', reversed=True)
+
+    for c in "(),….’!\"?»«':":
+        filename = filename.replace(c, '')
+
+    for c, r in (('—', '-'), ('/', '_'), ('№', 'N'), (' ', '_'), ('–', '-'), ('á', 'a'),
+                 ('\xa0', '_')):  # the original had a literal NBSP there
+        filename = filename.replace(c, r)
+
+    return filename + '.' + file_type
+
+
+def make_book(book_id: int, title: str, authors: list) -> Book:
+    return Book({"id": book_id, "title": title, "lang": "ru", "file_type": "fb2",
+                 "authors": [{"id": i, "first_name": first, "last_name": last, "middle_name": middle}
+                             for i, (first, last, middle) in enumerate(authors)]})
+
+
+def random_text(rnd: random.Random) -> str:
+    return "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(1, 40)))
+
+
+def corpus(samples: int, seed: int):
+    for book_id, title in enumerate(TITLES):
+        yield make_book(book_id, title, AUTHORS[:book_id % (len(AUTHORS) + 1)])
+    rnd = random.Random(seed)
+    for book_id in range(len(TITLES), len(TITLES) + samples):
+        authors = [(random_text(rnd), random_text(rnd), rnd.choice(("", random_text(rnd))))
+                   for _ in range(rnd.randint(0, 3))]
+        yield make_book(book_id, random_text(rnd), authors)
+
+
+def check(samples: int, seed: int) -> int:
+    mismatches = 0
+    for book in corpus(samples, seed):
+        for file_type in ("fb2", "epub", "mobi"):
+            filenames.clear()
+            expected, actual = reference_normalize(book, file_type), normalize(book, file_type)
+            if expected != actual:
+                mismatches += 1
+                print(f"{book.title!r}: expected {expected!r}, got {actual!r}")
+    return mismatches
+
+
+if __name__ == "__main__":
+    mismatches = check(int(sys.argv[1]) if len(sys.argv) > 1 else 20000, int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    print(f"{mismatches} mismatches")
+    sys.exit(1 if mismatches else 0)
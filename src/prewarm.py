@@ -0,0 +1,128 @@
+import asyncio
+import os
+import sys
+from collections import OrderedDict
+
+from telebot import logger
+
+import config
+from bot import AsyncBot
+from file_cache import CachedFile
+from filbusta_server import Book, NoContent
+from http_client import flibusta_client
+from ratelimit import SendScheduler, PRIORITY_LOW
+from send import Sender, normalize, get_posted_book, save_posted_book
+from utils import run_sync
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+from django.core.wsgi import get_wsgi_application
+from django.db.models import Exists, OuterRef
+
+application = get_wsgi_application()
+
+from db.models import BookRequest, PostedBook
+
+
+def load_candidates(limit: int) -> list:  # most requested (book_id, file_type) without a posted file
+    posted = PostedBook.objects.filter(book_id=OuterRef("book_id"), file_type=OuterRef("file_type"))
+    return list(BookRequest.objects.annotate(posted=Exists(posted)).filter(posted=False)
+                .order_by("-count").values_list("book_id", "file_type")[:limit])
+
+
+class Prewarmer:  # uploads popular books to a storage chat so users always get a cached file_id
+    def __init__(self, sender: Sender, chat_id: int, concurrency: int, budget: int, top: int, interval: float,
+                 books: list = ()):
+        self.sender = sender
+        self.chat_id = chat_id
+        self.concurrency = concurrency
+        self.budget = budget  # bytes downloaded per run
+        self.top = top
+        self.interval = interval
+        self.books = list(books)  # (book_id, file_type) warmed on every run
+        self.uploaded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes = 0
+        self._budget_left = 0
+
+    async def _upload(self, book_id: int, file_type: str) -> (str or None, bool):  # same result as Sender
+        posted = await run_sync(get_posted_book, book_id, file_type)
+        if posted is not None:
+            return posted[0], False
+        try:
+            book = await Book.get_by_id(book_id)
+        except NoContent:
+            return None, False
+        book_file = await self.sender.download(book_id, file_type)
+        if not book_file:
+            return None, False
+        try:
+            if not isinstance(book_file, CachedFile):  # only backend downloads count against the budget
+                self._budget_left -= book_file.size
+                self.bytes += book_file.size
+            if book_file.too_large:
+                return None, True
+            book_file.name = normalize(book, file_type)
+            response = await self.sender.bot.send_document(self.chat_id, book_file.file, filename=book_file.name,
+                                                           caption=book.caption, priority=PRIORITY_LOW)
+        finally:
+            book_file.close()
+        file_id = response.document.file_id
+        self.sender.file_ids.set((book_id, file_type), (file_id, book.caption))
+        await run_sync(save_posted_book, book_id, file_type, file_id, book.caption)
+        self.uploaded += 1
+        return file_id, False
+
+    async def warm(self, pairs: list):
+        self._budget_left = self.budget
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def warm_one(book_id: int, file_type: str):
+            async with semaphore:
+                if self._budget_left <= 0:  # in-flight uploads may overshoot by up to concurrency books
+                    self.skipped += 1
+                    return
+                try:
+                    # shares the flight with a user upload of the same book that is already running
+                    await self.sender.uploads.do((book_id, file_type), self._upload, book_id, file_type)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Prewarm {file_type}_{book_id}: {e}")
+
+        await asyncio.gather(*[warm_one(book_id, file_type) for book_id, file_type in OrderedDict.fromkeys(pairs)])
+
+    async def run(self):
+        while True:
+            try:
+                await self.warm(self.books + await run_sync(load_candidates, self.top))
+            except Exception as e:
+                logger.exception(f"Prewarmer.run: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {"uploaded": self.uploaded, "failed": self.failed, "skipped": self.skipped, "bytes": self.bytes}
+
+
+def read_books(path: str) -> list:  # "<book_id> <file_type>" per line
+    with open(path) as f:
+        return [(int(book_id), file_type) for book_id, file_type in (line.split() for line in f if line.strip())]
+
+
+async def warm_once(books: list):
+    scheduler = SendScheduler(config.TELEGRAM_GLOBAL_RATE, config.TELEGRAM_CHAT_RATE, config.TELEGRAM_GROUP_RATE,
+                              config.TELEGRAM_CHAT_BURST)
+    bot = AsyncBot(config.BOT_TOKEN, scheduler=scheduler, max_retries=config.TELEGRAM_MAX_RETRIES,
+                   api_url=config.TELEGRAM_API_URL)
+    prewarmer = Prewarmer(Sender(bot), config.PREWARM_CHAT_ID, config.PREWARM_CONCURRENCY, config.PREWARM_BUDGET,
+                          config.PREWARM_TOP, config.PREWARM_INTERVAL, config.PREWARM_BOOKS + books)
+    try:
+        await prewarmer.warm(prewarmer.books + await run_sync(load_candidates, prewarmer.top))
+    finally:
+        await bot.close()
+        await flibusta_client.close()
+    print(prewarmer.stats())
+
+
+if __name__ == "__main__":  # one run, with an optional file of extra books
+    asyncio.get_event_loop().run_until_complete(warm_once(read_books(sys.argv[1]) if len(sys.argv) > 1 else []))
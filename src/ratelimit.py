@@ -0,0 +1,133 @@
+import asyncio
+import time
+from collections import deque
+
+from cache import TTLCache
+
+PRIORITY_HIGH = 0  # documents and edits of search results
+PRIORITY_NORMAL = 1  # plain messages
+PRIORITY_LOW = 2  # chat actions
+
+CHAT_ACTION_TTL = 4  # Telegram shows a chat action for 5 seconds
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.paused_until > now:
+            return self.paused_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = time.monotonic() + seconds
+        self.tokens = 0
+
+
+class SendScheduler:  # grants outbound Bot API calls by priority within global and per-chat limits
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float, chat_burst: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = TTLCache(100000, 10 * 60)
+        self.lanes = (deque(), deque(), deque())  # (chat_id, future, enqueued_at) by priority
+        self.chat_actions = TTLCache(100000, CHAT_ACTION_TTL)  # (chat_id, action) -> last sent
+        self.coalesced = 0
+        self.granted = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self._wakeup = None  # type: asyncio.Event
+        self._task = None  # type: asyncio.Future
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, self.chat_burst)
+        self.chat_buckets.set(chat_id, bucket)  # refresh ttl
+        return bucket
+
+    def should_send_chat_action(self, chat_id: int, action: str) -> bool:
+        if (chat_id, action) in self.chat_actions:
+            self.coalesced += 1
+            return False
+        self.chat_actions.set((chat_id, action), True)
+        return True
+
+    def pause(self, chat_id: int or None, seconds: float):  # honor retry_after from a 429
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            self._chat_bucket(chat_id).pause(seconds)
+
+    async def acquire(self, chat_id: int, priority: int = PRIORITY_NORMAL):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        future = asyncio.get_event_loop().create_future()
+        self.lanes[priority].append((chat_id, future, time.monotonic()))
+        self._wakeup.set()
+        await future
+
+    def _next(self) -> (tuple or None, float or None):
+        now = time.monotonic()
+        delay = self.global_bucket.wait_time(now)
+        if delay > 0:
+            return None, delay
+        delay = None
+        for lane in self.lanes:
+            for item in list(lane):
+                chat_id, future, _ = item
+                if future.done():  # caller was cancelled
+                    lane.remove(item)
+                    continue
+                chat_delay = self._chat_bucket(chat_id).wait_time(now)
+                if chat_delay <= 0:
+                    lane.remove(item)
+                    return item, None
+                delay = chat_delay if delay is None else min(delay, chat_delay)
+        return None, delay
+
+    async def _run(self):
+        while True:
+            item, delay = self._next()
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            chat_id, future, enqueued_at = item
+            self.global_bucket.consume()
+            self._chat_bucket(chat_id).consume()
+            waited = time.monotonic() - enqueued_at
+            self.granted += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+            future.set_result(None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": {"high": len(self.lanes[PRIORITY_HIGH]), "normal": len(self.lanes[PRIORITY_NORMAL]),
+                            "low": len(self.lanes[PRIORITY_LOW])},
+            "granted": self.granted,
+            "coalesced_chat_actions": self.coalesced,
+            "wait_time_avg": self.wait_time_total / self.granted if self.granted else 0.0,
+            "wait_time_max": self.wait_time_max,
+        }
@@ -1,18 +1,31 @@
+import asyncio
 import os
 
+import aiohttp
 import transliterate as transliterate
-from telebot import TeleBot
+from telebot import logger
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
-from filbusta_server import Book, Author, BytesResult
+
+import config
+from bot import AsyncBot
+from cache import TTLCache
+from convert import Converter
+from file_cache import CachedFile
+from filbusta_server import Book, Author, DownloadResult, NoContent, share_markup
+from singleflight import SingleFlight
+from users import user_settings
+from utils import run_sync
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
 
 from django.core.wsgi import get_wsgi_application
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, connection
+from django.utils import timezone
 
 application = get_wsgi_application()
 
-from db.models import TelegramUser, PostedBook
+from db.models import PostedBook, BookRequest
 
 ELEMENTS_ON_PAGE = 7
 BOOKS_CHANGER = 5
@@ -46,109 +59,237 @@ def get_keyboard(page: int, pages_count: int, keyboard_type: str) -> InlineKeybo
     return keyboard
 
 
+def _make_filename_table() -> dict:  # translit + char filtering as one str.translate table
+    table = {ord(c): None for c in "(),….’!\"?»«':"}
+    table.update({ord(c): r for c, r in (('—', '-'), ('/', '_'), ('№', 'N'), (' ', '_'), ('–', '-'), ('á', 'a'),
+                                         ('\xa0', '_'))})
+    for code in range(0x0400, 0x0530):  # Cyrillic chars are transliterated char by char
+        latin = transliterate.translit(chr(code), 'ru', reversed=True)
+        if latin != chr(code):
+            table[code] = latin.translate(table)
+    return table
+
+
+FILENAME_TABLE = _make_filename_table()
+filenames = TTLCache(config.FILENAME_CACHE_SIZE, config.FILENAME_CACHE_TTL)
+
+
 def normalize(book: Book, file_type: str) -> str:  # remove chars that don't accept in Telegram Bot API
-    filename = '_'.join([a.short for a in book.authors]) + '_-_' if book.authors else ''
-    filename += book.title if book.title[-1] != ' ' else book.title[:-1]
-    filename = transliterate.translit(filename, 'ru', reversed=True)
+    filename = filenames.get((book.id, file_type))
+    if filename is None:
+        filename = '_'.join([a.short for a in book.authors]) + '_-_' if book.authors else ''
+        filename += book.title if book.title[-1] != ' ' else book.title[:-1]
+        filename = filename.translate(FILENAME_TABLE) + '.' + file_type
+        filenames.set((book.id, file_type), filename)
+    return filename
+
+
+def get_posted_book(book_id: int, file_type: str) -> (str, str or None) or None:  # file_id and caption
+    try:
+        return PostedBook.objects.values_list("file_id", "caption").get(book_id=book_id, file_type=file_type)
+    except ObjectDoesNotExist:
+        return None
 
-    for c in "(),….’!\"?»«':":
-        filename = filename.replace(c, '')
 
-    for c, r in (('—', '-'), ('/', '_'), ('№', 'N'), (' ', '_'), ('–', '-'), ('á', 'a'), (' ', '_')):
-        filename = filename.replace(c, r)
+def save_posted_book(book_id: int, file_type: str, file_id: str, caption: str):
+    try:
+        PostedBook.objects.update_or_create(book_id=book_id, file_type=file_type,
+                                            defaults={"file_id": file_id, "caption": caption})
+    except IntegrityError:  # another process has just saved the same book
+        pass
 
-    return filename + '.' + file_type
+
+async def get_caption(book_id: int) -> str or None:  # None sends the book without a caption
+    try:
+        return (await Book.get_by_id(book_id)).caption
+    except (NoContent, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logger.warning(f"No caption for book {book_id}: {e!r}")
+        return None
+
+
+def add_book_requests(counts: dict):
+    table = BookRequest._meta.db_table
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(counts))
+    now = timezone.now()
+    params = [value for (book_id, file_type), count in counts.items() for value in (book_id, file_type, count, now)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (book_id, file_type, count, last_requested) VALUES {values} "
+            f"ON CONFLICT (book_id, file_type) DO UPDATE SET count = {table}.count + EXCLUDED.count, "
+            f"last_requested = EXCLUDED.last_requested",
+            params
+        )
+
+
+class BookRequestCounter:  # write-behind for BookRequest, the request history used by prewarm
+    def __init__(self, flush_interval: float):
+        self.counts = {}  # (book_id, file_type) -> requests since the last flush
+        self.flush_interval = flush_interval
+
+    def hit(self, book_id: int, file_type: str):
+        self.counts[(book_id, file_type)] = self.counts.get((book_id, file_type), 0) + 1
+
+    async def flush(self):
+        if not self.counts:
+            return
+        counts, self.counts = self.counts, {}
+        try:
+            await run_sync(add_book_requests, counts)
+        except Exception:
+            for key, count in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + count
+            raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"BookRequestCounter.flush: {e}")
 
 
 class Sender:
-    def __init__(self, bot: TeleBot):
+    def __init__(self, bot: AsyncBot, requests: BookRequestCounter = None, converter: Converter = None):
         self.bot = bot
+        self.requests = requests
+        self.converter = converter  # local conversion when flibusta_server fails to give an epub or mobi
+        # (book_id, file_type) -> download and upload in progress, shared by worker processes in cluster mode
+        self.uploads = SingleFlight(config.SINGLE_FLIGHT_LOCK_DIR if config.WORKER_PROCESSES > 1 else None)
+        # remove_cache in one worker doesn't reach the caches of the others, they forget file_ids sooner
+        self.file_ids = TTLCache(config.FILE_ID_CACHE_SIZE, config.FILE_ID_CACHE_TTL if config.WORKER_PROCESSES == 1
+                                 else min(config.FILE_ID_CACHE_TTL, config.FILE_ID_CACHE_CLUSTER_TTL))
+        self.pages = TTLCache(config.PAGE_CACHE_SIZE, config.PAGE_CACHE_TTL, config.PAGE_CACHE_MAX_BYTES)
 
-    @staticmethod
-    def remove_cache(type_: str, id_: int):
-        try:
-            PostedBook.objects.get(file_type=type_, book_id=id_).delete()
-        except ObjectDoesNotExist:
-            pass
+    async def remove_cache(self, type_: str, id_: int):
+        self.file_ids.pop((id_, type_))
+        await run_sync(PostedBook.objects.filter(file_type=type_, book_id=id_).delete)
+
+    async def download(self, book_id: int, file_type: str) -> DownloadResult or CachedFile or None:
+        if self.converter is not None:
+            return await self.converter.download(book_id, file_type)
+        return await Book.download(book_id, file_type)
+
+    async def get_posted(self, book_id: int, file_type: str) -> (str, str or None) or None:
+        posted = self.file_ids.get((book_id, file_type))
+        if posted is None:
+            posted = await run_sync(get_posted_book, book_id, file_type)
+            if posted is not None:
+                self.file_ids.set((book_id, file_type), posted)
+        return posted
+
+    async def get_file_id(self, book_id: int, file_type: str) -> str or None:
+        posted = await self.get_posted(book_id, file_type)
+        return posted[0] if posted is not None else None
 
-    def send_book(self, msg: Message, book_id: int, file_type: str):
+    async def send_book(self, msg: Message, book_id: int, file_type: str):
+        posted = await self.get_posted(book_id, file_type)
+        if posted is not None:  # a posted book is sent without flibusta_server
+            if self.requests is not None:
+                self.requests.hit(book_id, file_type)
+            file_id, caption = posted
+            if caption is None:  # posted before captions were saved
+                caption = await get_caption(book_id)
+            return await self.bot.send_document(msg.chat.id, file_id, reply_to_message_id=msg.message_id,
+                                                caption=caption, reply_markup=share_markup(book_id))
         try:
-            book = Book.get_by_id(book_id)
-        except ObjectDoesNotExist:
-            self.bot.reply_to(msg, "Книга не найдена!")
+            book = await Book.get_by_id(book_id)  # served from metadata_cache on repeated requests
+        except NoContent:
+            await self.bot.reply_to(msg, "Книга не найдена!")
             return
+        if self.requests is not None:
+            self.requests.hit(book_id, file_type)
+        (file_id, too_large), leader = await self.uploads.do((book_id, file_type), self._upload_book,
+                                                             msg, book, file_type)
+        if leader:
+            return
+        if too_large:
+            return await self.bot.send_message(msg.chat.id, book.caption, reply_to_message_id=msg.message_id,
+                                               reply_markup=book.get_download_markup(file_type))
+        if file_id is None:
+            return await self.bot.reply_to(msg, "Ошибка! Попробуйте позже :(")
+        await self.bot.send_document(msg.chat.id, file_id, reply_to_message_id=msg.message_id,
+                                     caption=book.caption, reply_markup=book.share_markup)
+
+    async def _upload_book(self, msg: Message, book: Book, file_type: str) -> (str or None, bool):
+        posted = await run_sync(get_posted_book, book.id, file_type)
+        if posted is not None:  # uploaded by another process while we waited for the lock
+            self.file_ids.set((book.id, file_type), posted)
+            file_id = posted[0]
+            await self.bot.send_document(msg.chat.id, file_id, reply_to_message_id=msg.message_id,
+                                         caption=book.caption, reply_markup=book.share_markup)
+            return file_id, False
+        await self.bot.send_chat_action(msg.chat.id, "upload_document")
+        book_file = await self.download(book.id, file_type)
+        if not book_file:
+            await self.bot.reply_to(msg, "Ошибка! Попробуйте позже :(")
+            return None, False
         try:
-            try:
-                pb = PostedBook.objects.get(book_id=book_id, file_type=file_type)
-                self.bot.send_document(msg.chat.id, pb.file_id, reply_to_message_id=msg.message_id,
-                                       caption=book.caption, reply_markup=book.share_markup)
-            except MultipleObjectsReturned:
-                PostedBook.objects.filter(book_id=book_id, file_type=file_type).delete()
-                raise ObjectDoesNotExist
-        except ObjectDoesNotExist:
-            self.bot.send_chat_action(msg.chat.id, "upload_document")
-            book_bytes = Book.download(book_id, file_type)  # type: BytesResult
-            if not book_bytes:
-                return self.bot.reply_to(msg, "Ошибка! Попробуйте позже :(")
-            if book_bytes.size > 30 * 1000000:
-                return self.bot.send_message(msg.chat.id, book.caption, reply_to_message_id=msg.message_id,
-                                             reply_markup=book.get_download_markup(file_type))
-            book_bytes.name = normalize(book, file_type)
-            send_response = self.bot.send_document(msg.chat.id, book_bytes, reply_to_message_id=msg.message_id,
-                                                   caption=book.caption, reply_markup=book.share_markup)
-            PostedBook.objects.create(book_id=book_id, file_type=file_type, file_id=send_response.document.file_id
-                                      ).save()
-
-    def search_books(self, msg: Message, page: int):
-        user = TelegramUser.objects.get(user_id=msg.chat.id)
-        allowed_langs = []
-        if user.settings is not None:
-            if user.settings.allow_uk:
-                allowed_langs.append("uk")
-            if user.settings.allow_be:
-                allowed_langs.append("be")
-        self.bot.send_chat_action(msg.chat.id, 'typing')
-        books = Book.search(msg.reply_to_message.text, allowed_langs)
-        if not books:
-            self.bot.edit_message_text('Книги не найдены!', chat_id=msg.chat.id, message_id=msg.message_id)
+            if book_file.too_large:
+                await self.bot.send_message(msg.chat.id, book.caption, reply_to_message_id=msg.message_id,
+                                            reply_markup=book.get_download_markup(file_type))
+                return None, True
+            book_file.name = normalize(book, file_type)
+            send_response = await self.bot.send_document(msg.chat.id, book_file.file, filename=book_file.name,
+                                                         reply_to_message_id=msg.message_id,
+                                                         caption=book.caption, reply_markup=book.share_markup)
+        finally:
+            book_file.close()
+        file_id = send_response.document.file_id
+        self.file_ids.set((book.id, file_type), (file_id, book.caption))
+        await run_sync(save_posted_book, book.id, file_type, file_id, book.caption)
+        return file_id, False
+
+    async def _get_page(self, chat_id: int, key: tuple, page: int, fetch, render, keyboard_type: str
+                        ) -> (str, str or None) or None:
+        rendered = self.pages.get((key, page))
+        if rendered is None:
+            await self.bot.send_chat_action(chat_id, 'typing')
+            result = await fetch()
+            if not result.total:
+                return None
+            text = ''.join(render(item) for item in result.items) + f'<code>Страница {page}/{result.page_count}</code>'
+            keyboard = get_keyboard(page, result.page_count, keyboard_type)
+            rendered = text, keyboard.to_json() if keyboard else None
+            self.pages.set((key, page), rendered, weight=len(text))
+        return rendered
+
+    async def search_books(self, msg: Message, page: int):
+        query = msg.reply_to_message.text
+        allowed_langs = await user_settings.get_allowed_langs(msg.chat.id)
+        rendered = await self._get_page(msg.chat.id, ("b", query, allowed_langs), page,
+                                        lambda: Book.search_page(query, allowed_langs, page, ELEMENTS_ON_PAGE),
+                                        lambda book: book.to_send_book, 'b')
+        if rendered is None:
+            await self.bot.edit_message_text('Книги не найдены!', chat_id=msg.chat.id, message_id=msg.message_id)
             return
-        page_count = len(books) // ELEMENTS_ON_PAGE + (1 if len(books) % ELEMENTS_ON_PAGE != 0 else 1)
-        msg_text = ''.join(book.to_send_book for book in books[ELEMENTS_ON_PAGE * (page - 1):ELEMENTS_ON_PAGE * page]
-                           ) + f'<code>Страница {page}/{page_count}</code>'
-        self.bot.edit_message_text(msg_text, chat_id=msg.chat.id, message_id=msg.message_id, parse_mode='HTML',
-                                   reply_markup=get_keyboard(page, page_count, 'b'))
-
-    def search_authors(self, msg: Message, page: int):
-        self.bot.send_chat_action(msg.chat.id, 'typing')
-        authors = Author.search(msg.reply_to_message.text)
-        if not authors:
-            self.bot.send_message(msg.chat.id, 'Автор не найден!')
+        msg_text, keyboard = rendered
+        await self.bot.edit_message_text(msg_text, chat_id=msg.chat.id, message_id=msg.message_id,
+                                         parse_mode='HTML', reply_markup=keyboard)
+
+    async def search_authors(self, msg: Message, page: int):
+        query = msg.reply_to_message.text
+        rendered = await self._get_page(msg.chat.id, ("a", query), page,
+                                        lambda: Author.search_page(query, page, ELEMENTS_ON_PAGE),
+                                        lambda author: author.to_send, 'a')
+        if rendered is None:
+            await self.bot.send_message(msg.chat.id, 'Автор не найден!')
             return
-        page_max = len(authors) // ELEMENTS_ON_PAGE + (1 if len(authors) % ELEMENTS_ON_PAGE != 0 else 1)
-        msg_text = ''.join(author.to_send for author in authors[ELEMENTS_ON_PAGE * (page - 1):ELEMENTS_ON_PAGE * page]
-                           ) + f'<code>Страница {page}/{page_max}</code>'
-        self.bot.edit_message_text(msg_text, chat_id=msg.chat.id, message_id=msg.message_id, parse_mode='HTML',
-                                   reply_markup=get_keyboard(page, page_max, 'a'))
-
-    def search_books_by_author(self, msg: Message, author_id: int, page: int):
-        user = TelegramUser.objects.get(user_id=msg.chat.id)
-        allowed_langs = []
-        if user.settings is not None:
-            if user.settings.allow_uk:
-                allowed_langs.append("uk")
-            if user.settings.allow_be:
-                allowed_langs.append("be")
-        self.bot.send_chat_action(msg.chat.id, 'typing')
-        books = Book.by_author(author_id, allowed_langs)
-        if not books:
-            self.bot.reply_to(msg, 'Ошибка! Книги не найдены!')
+        msg_text, keyboard = rendered
+        await self.bot.edit_message_text(msg_text, chat_id=msg.chat.id, message_id=msg.message_id,
+                                         parse_mode='HTML', reply_markup=keyboard)
+
+    async def search_books_by_author(self, msg: Message, author_id: int, page: int):
+        allowed_langs = await user_settings.get_allowed_langs(msg.chat.id)
+        rendered = await self._get_page(msg.chat.id, ("ba", author_id, allowed_langs), page,
+                                        lambda: Book.by_author_page(author_id, allowed_langs, page, ELEMENTS_ON_PAGE),
+                                        lambda book: book.to_send_book, 'ba')
+        if rendered is None:
+            await self.bot.reply_to(msg, 'Ошибка! Книги не найдены!')
             return
-        page_max = len(books) // ELEMENTS_ON_PAGE + (1 if len(books) % ELEMENTS_ON_PAGE != 0 else 1)
-        msg_text = ''.join([book.to_send_book
-                            for book in books[ELEMENTS_ON_PAGE * (page - 1):ELEMENTS_ON_PAGE * page]]
-                           ) + f'<code>Страница {page}/{page_max}</code>'
+        msg_text, keyboard = rendered
         if not msg.reply_to_message:
-            self.bot.reply_to(msg, msg_text, parse_mode='HTML', reply_markup=get_keyboard(1, page_max, 'ba'))
+            await self.bot.reply_to(msg, msg_text, parse_mode='HTML', reply_markup=keyboard)
         else:
-            self.bot.edit_message_text(msg_text, msg.chat.id, msg.message_id, parse_mode='HTML',
-                                       reply_markup=get_keyboard(page, page_max, 'ba'))
+            await self.bot.edit_message_text(msg_text, msg.chat.id, msg.message_id, parse_mode='HTML',
+                                             reply_markup=keyboard)
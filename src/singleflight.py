@@ -0,0 +1,62 @@
+import asyncio
+import fcntl
+import os
+import zlib
+
+import metrics
+
+LOCK_POLL_INTERVAL = 0.1
+
+
+class FileLock:  # flock based, so it also excludes other processes on the host
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    async def acquire(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+class SingleFlight:  # concurrent calls with the same key share one execution
+    def __init__(self, lock_dir: str = None, lock_stripes: int = 1024):
+        self.lock_dir = lock_dir  # set to serialize leaders of all processes sharing the directory
+        self.lock_stripes = lock_stripes
+        self._calls = {}  # key -> asyncio.Future
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    async def _run_locked(self, key, func, *args, **kwargs):
+        stripe = zlib.crc32(repr(key).encode()) % self.lock_stripes
+        lock = FileLock(os.path.join(self.lock_dir, f"{stripe}.lock"))
+        await lock.acquire()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            lock.release()
+
+    async def do(self, key, func, *args, **kwargs) -> (object, bool):  # returns (result, is_leader)
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            if self.lock_dir is not None:
+                task = asyncio.ensure_future(self._run_locked(key, func, *args, **kwargs))
+            else:
+                task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            metrics.share_trace(task)
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task), leader
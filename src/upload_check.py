@@ -0,0 +1,76 @@
+import asyncio
+import io
+import sys
+import tempfile
+
+from aiohttp import web
+
+from bot import AsyncBot
+from file_cache import CachedFile
+
+# Checks that an upload answered with 429 Too Many Requests is sent again in full and stays open for its owner,
+# for downloads in memory, spooled to disk and mapped from the file cache:
+# python upload_check.py
+
+PORT = 18090
+BODY = bytes(range(256)) * 4096  # 1 MB, several upload chunks
+
+
+class FakeTelegram:  # answers the first sendDocument of every file with 429
+    def __init__(self):
+        self.calls = 0
+        self.received = []
+
+    async def handle(self, request):
+        data = await request.post()
+        self.calls += 1
+        if self.calls % 2 == 1:
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                      "parameters": {"retry_after": 0}})
+        self.received.append(data["document"].file.read())
+        return web.json_response({"ok": True, "result": {"message_id": self.calls, "date": 0,
+                                                         "chat": {"id": 1, "type": "private"},
+                                                         "document": {"file_id": f"file_{self.calls}"}}})
+
+
+def sources() -> list:
+    spooled = tempfile.TemporaryFile()
+    spooled.write(BODY)
+    with tempfile.NamedTemporaryFile() as cached:
+        cached.write(BODY)
+        cached.flush()
+        mapped = CachedFile(cached.name)
+    return [("BytesIO", io.BytesIO(BODY)), ("TemporaryFile", spooled), ("CachedFile", mapped)]
+
+
+async def check() -> int:
+    telegram = FakeTelegram()
+    app = web.Application(client_max_size=2 * len(BODY))
+    app.router.add_post("/bot{token}/{method}", telegram.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    bot = AsyncBot("0:check", max_retries=1, api_url=f"http://127.0.0.1:{PORT}/bot{{0}}/{{1}}")
+    failures = 0
+    try:
+        for name, source in sources():
+            file = source.file if isinstance(source, CachedFile) else source
+            received = len(telegram.received)
+            try:
+                await bot.send_document(1, file, filename="book.fb2")
+                ok = telegram.received[received:] == [BODY] and not getattr(file, "closed", False)
+            except Exception as e:
+                print(f"{name}: {e!r}")
+                ok = False
+            finally:
+                source.close()
+            print(f"{name}: {'ok' if ok else 'FAILED'}")
+            failures += not ok
+    finally:
+        await bot.close()
+        await runner.cleanup()
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.get_event_loop().run_until_complete(check()) else 0)
@@ -0,0 +1,109 @@
+import asyncio
+import os
+
+import telebot.types as ttypes
+from telebot import logger
+
+import config
+from cache import TTLCache
+from utils import run_sync
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+from django.core.wsgi import get_wsgi_application
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+
+application = get_wsgi_application()
+
+from db.models import TelegramUser
+
+
+def upsert_users(profiles: dict):
+    table = TelegramUser._meta.db_table
+    values = ", ".join(["(%s, %s, %s, %s)"] * len(profiles))
+    params = [value for user_id, profile in profiles.items() for value in (user_id, *profile)]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (user_id, first_name, last_name, username) VALUES {values} "
+            f"ON CONFLICT (user_id) DO UPDATE SET first_name = EXCLUDED.first_name, "
+            f"last_name = EXCLUDED.last_name, username = EXCLUDED.username",
+            params
+        )
+
+
+class UserWriter:  # write-behind for TelegramUser profiles
+    def __init__(self, cache_size: int, cache_ttl: float, flush_interval: float, batch_size: int):
+        self.seen = TTLCache(cache_size, cache_ttl)  # user_id -> (first_name, last_name, username)
+        self.dirty = {}
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+    def update(self, user: ttypes.User):
+        profile = (user.first_name, user.last_name, user.username)
+        if self.seen.get(user.id) == profile:
+            return
+        self.seen.set(user.id, profile)
+        self.dirty[user.id] = profile
+
+    async def save(self, user: ttypes.User):  # writes one profile now, for handlers that need its row
+        profile = (user.first_name, user.last_name, user.username)
+        self.seen.set(user.id, profile)
+        self.dirty.pop(user.id, None)
+        try:
+            await run_sync(upsert_users, {user.id: profile})
+        except Exception:
+            self.dirty.setdefault(user.id, profile)
+            raise
+
+    async def flush(self):
+        while self.dirty:
+            batch = dict(list(self.dirty.items())[:self.batch_size])
+            for user_id in batch:
+                del self.dirty[user_id]
+            try:
+                await run_sync(upsert_users, batch)
+            except Exception:
+                for user_id, profile in batch.items():
+                    self.dirty.setdefault(user_id, profile)
+                raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"UserWriter.flush: {e}")
+
+
+def load_allowed_langs(user_id: int) -> tuple:
+    try:
+        user = TelegramUser.objects.select_related("settings").get(user_id=user_id)
+    except ObjectDoesNotExist:  # not flushed by UserWriter yet, use default settings
+        return ()
+    allowed_langs = []
+    if user.settings is not None:
+        if user.settings.allow_uk:
+            allowed_langs.append("uk")
+        if user.settings.allow_be:
+            allowed_langs.append("be")
+    return tuple(allowed_langs)
+
+
+class SettingsService:
+    def __init__(self, cache_size: int, cache_ttl: float):
+        self.allowed_langs = TTLCache(cache_size, cache_ttl)  # user_id -> tuple of langs
+
+    async def get_allowed_langs(self, user_id: int) -> tuple:
+        allowed_langs = self.allowed_langs.get(user_id)
+        if allowed_langs is None:
+            allowed_langs = await run_sync(load_allowed_langs, user_id)
+            self.allowed_langs.set(user_id, allowed_langs)
+        return allowed_langs
+
+    def invalidate(self, user_id: int):
+        self.allowed_langs.pop(user_id)
+
+
+user_settings = SettingsService(config.SETTINGS_CACHE_SIZE, config.SETTINGS_CACHE_TTL)
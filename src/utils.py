@@ -0,0 +1,18 @@
+import asyncio
+import functools
+
+import metrics
+
+
+def _call_traced(trace: metrics.Trace, func, *args, **kwargs):
+    metrics.bind_thread(trace)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.bind_thread(None)
+
+
+async def run_sync(func, *args, **kwargs):  # run blocking code (Django ORM, chatbase) off the event loop
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(_call_traced, metrics.current_trace(), func,
+                                                              *args, **kwargs))